@@ -2,37 +2,38 @@
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from collections import defaultdict
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from mmap import ACCESS_READ, mmap
 from pathlib import Path
-from random import randrange, seed
+from phases import open_timed, profiler
+from random import Random
+from results import ResultStore, load_results
+from sketch import Sketch
 from subprocess import PIPE, Popen
 from tempfile import TemporaryFile
-from time import perf_counter, process_time
-from util import algorithms, posint
+from threading import Thread
+from tracecache import cached_trace, file_hash
+from util import algorithms, executable_path, posint
 
-import bz2
+import hashlib
 import json
 import math
+import os
+import signal
 import sys
 
-import tracemalloc
-
-Ta, Tb = None, None
-def prof_start():
-  global Ta, Tb
-  assert Ta is None
-  Ta, Tb = perf_counter(), process_time()
-def prof_stop(kind):
-  global Ta, Tb
-  sys.stderr.write('{:5.01f} {:5.01f} {}\n'.format(
-    perf_counter() - Ta, process_time() - Tb, kind))
-  sys.stderr.flush()
-  Ta, Tb = None, None
+profile_file_name = 'profile.json'
 
 argparser = ArgumentParser(description='''\
   Runs treebuffer with several algorithms, and summarizes logs. The logs
-  themselves are removed, because they are huge.
-''', formatter_class=RawDescriptionHelpFormatter)
+  are summarized as they are produced, and never stored, because they are
+  huge.
+
+  Where the time goes is written to {}, next to the results: wall and CPU
+  time of each phase (preparing the trace, each cell, and within a cell
+  feeding main, waiting for it, and summarizing), and the resource usage of
+  main. See phases.py.
+'''.format(profile_file_name), formatter_class=RawDescriptionHelpFormatter)
 
 argparser.add_argument('data',
   help='file that contains list of trebuffer operations (may be .bz2)')
@@ -41,8 +42,9 @@ argparser.add_argument('-H', '--history', type=posint, default=10,
 argparser.add_argument('-A', '--algorithm', nargs='+',
   choices=algorithms, default=algorithms,
   help='which algorithms to try')
-argparser.add_argument('-E', '--executable', default='../main',
-  help='executable')
+argparser.add_argument('-E', '--executable', type=executable_path,
+  default='../main',
+  help='executable: a path, or a command in PATH')
 argparser.add_argument('-O', '--outdir', default='plot_data',
   help='where to put the plot data files')
 argparser.add_argument('-P', '--points', type=posint, default=100,
@@ -53,38 +55,154 @@ argparser.add_argument('-S', '--step-bin', type=posint, default=10,
   help='bin size for steps histogram')
 argparser.add_argument('-K', '--keep-history', action='store_true',
   help='keep "history" operations; by default, skipped')
+argparser.add_argument('-j', '--jobs', type=posint, default=1,
+  help='how many (history, algorithm) cells to run in parallel')
+argparser.add_argument('-a', '--aggregate', action='store_true',
+  help='have main aggregate its statistics, which is faster; time series then '
+  'have only their end points, and large steps are binned approximately')
+argparser.add_argument('-T', '--timing', action='store_true',
+  help='also measure wall-clock latency of operations; implies --aggregate')
+argparser.add_argument('-L', '--lockstep', action='store_true',
+  help='have each run of main replay the trace into several cells at once, '
+  'so that it is parsed once per job instead of once per cell')
+argparser.add_argument('--json', action='store_true',
+  help='also write a JSON file per series, besides {}'.format(
+    ResultStore.file_name))
+argparser.add_argument('-R', '--rerun', action='store_true',
+  help='run all cells; by default, cells already in {} for the same dataset, '
+  'executable and options are kept'.format(ResultStore.file_name))
+argparser.add_argument('-C', '--cache-dir',
+  help='where to keep decompressed datasets (default: OUTDIR/cache)')
+argparser.add_argument('--profile-python', action='store_true',
+  help='record in {} the functions that take most time, per phase '
+  '(cProfile)'.format(profile_file_name))
+argparser.add_argument('--profile-memory', action='store_true',
+  help='record in {} the memory that Python allocates, per phase '
+  '(tracemalloc)'.format(profile_file_name))
+
+def feed(stdin, trace_file, history, algorithm):
+  with stdin:
+    stdin.write('initialize {} {} 0:-1\n'.format(history, algorithm).encode())
+    if Path(trace_file.name).stat().st_size > 0:
+      with mmap(trace_file.fileno(), 0, access=ACCESS_READ) as data:
+        stdin.write(data)
+
+# A main that stops reading is reported by reap.
+def feed_phase(phase, *args):
+  with profiler.phase('feed', parent=phase):
+    try:
+      feed(*args)
+    except BrokenPipeError:
+      pass
+
+# Passes on the |lines| of statistics of main, except the max-rss-kib line that
+# it writes at exit, whose value goes in |found|.
+def take_rss(lines, found):
+  for line in lines:
+    if line[0] == 'm':
+      found['max-rss-kib'] = int(line.split()[1])
+    else:
+      yield line
+
+# Waits for |p|, adds its resource usage, with the peak RSS it reported in
+# |found| (see take_rss), to the current phase, and raises if it failed, so
+# that its statistics, which may be cut short, are not used. If
+# |reader_failed|, p being killed for writing to a closed pipe is not its
+# failure.
+def reap(p, found, reader_failed=False):
+  _, status, usage = os.wait4(p.pid, 0)
+  p.returncode = os.waitstatus_to_exitcode(status)
+  profiler.add_child(Path(p.args[0]).name, usage, found.get('max-rss-kib'))
+  if reader_failed and p.returncode == -signal.SIGPIPE:
+    return
+  if p.returncode != 0:
+    raise RuntimeError('{} exited with {}'.format(p.args[0], p.returncode))
+
+# Runs |program| on |trace|, a plain file prepared by cached_trace, and yields
+# the lines of statistics as |program| writes them to a pipe. Another thread
+# feeds the trace to |program|. The time spent waiting for |program| is
+# counted as pipe-wait of the current phase.
+def run(program, trace, history, algorithm, options=[]):
+  phase = profiler.current()
+  stats_in, stats_out = os.pipe()
+  found = {}
+  with open(trace, 'rb') as in_file:
+    with TemporaryFile() as out_file:
+      with Popen([program] + options + ['-s', 'fd:{}'.format(stats_out), '-'],
+          stdin=PIPE, stdout=out_file, pass_fds=(stats_out,)) as p:
+        os.close(stats_out)
+        feeder = Thread(target=feed_phase,
+          args=(phase, p.stdin, in_file, history, algorithm))
+        feeder.start()
+        try:
+          with open_timed(stats_in, phase, 'pipe-wait', 1 << 20) as log_file:
+            yield from take_rss(log_file, found)
+        except GeneratorExit:
+          # The reader failed, maybe because |program| did.
+          feeder.join()
+          reap(p, found, reader_failed=True)
+          raise
+        feeder.join()
+        reap(p, found)
 
-def run(program, data, keep_history, history, algorithm):
-  prof_start()
-  def bz2_open(f):
-    return bz2.open(f, 'rt')
-  open_data = bz2_open if data.endswith('.bz2') else open
-  with open_data(data) as in_file:
+# Like run, but for several (history, algorithm, prefix) |cells| at once, each
+# with its own pipe. Returns the results of |summarize|(cell, lines), which
+# runs in a thread per cell, in a phase of its own.
+def run_lockstep(program, trace, cells, options, summarize):
+  phase = profiler.current()
+  pipes = [os.pipe() for _ in cells]
+  trees = []
+  for (history, algorithm, _), (_, stats_out) in zip(cells, pipes):
+    trees += ['-m', '{}:{}:fd:{}'.format(history, algorithm, stats_out)]
+  results = [None] * len(cells)
+  found = {} # each tree reports the same peak RSS, that of main
+  errors = []
+  def consume(i, stats_in):
+    try:
+      with profiler.phase('summarize', parent=phase, cell=cells[i][2]) as p:
+        with open_timed(stats_in, p, 'pipe-wait', 1 << 20) as log_file:
+          results[i] = summarize(cells[i], take_rss(log_file, found))
+    except Exception as e:
+      errors.append(e)
+  with open(trace, 'rb') as in_file:
     with TemporaryFile() as out_file:
-      with Popen([program, '-'], stdin=PIPE, stdout=out_file, universal_newlines=True) as p:
-        p.stdin.write('initialize {} {} 0:-1\n'.format(history, algorithm))
-        for line in in_file:
-          if keep_history or not (len(line) > 0 and line[0] == 'h'):
-            p.stdin.write(line)
-  prof_stop('run')
-
-def parse_log():
-  prof_start()
+      with Popen([program] + options + trees + ['-'], stdin=PIPE,
+          stdout=out_file, pass_fds=[w for _, w in pipes]) as p:
+        for _, stats_out in pipes:
+          os.close(stats_out)
+        history, algorithm, _ = cells[0]
+        threads = [Thread(target=feed_phase,
+          args=(phase, p.stdin, in_file, history, algorithm))]
+        threads += [Thread(target=consume, args=(i, stats_in))
+          for i, (stats_in, _) in enumerate(pipes)]
+        for t in threads:
+          t.start()
+        for t in threads:
+          t.join()
+        reap(p, found, reader_failed=bool(errors))
+  if errors:
+    raise errors[0]
+  return results
+
+def parse_log(log_file):
   node_delta = 0
-  with open('treebuffer.stats') as log_file:
-    for line in log_file:
-      if line[0] == 'S':
-        node_delta += int(line[2:])
-      else:
-        yield (int(line[3:]), node_delta)
-        node_delta = 0
-  prof_stop('parse_log')
-  return
+  for line in log_file:
+    if line[0] == 'S':
+      node_delta += int(line[2:])
+    else:
+      yield (int(line[3:]), node_delta)
+      node_delta = 0
+
 
+quantiles = [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)]
 
 # TODO: nodes histogram takes a alot of memory for naive algo;
-#   perhaps adaptively drop it if it gets too big?
-def summarize_log(points_count, steps_bin, nodes_bin, outdir, prefix):
+#   perhaps adaptively drop it if it gets too big? Meanwhile, the quantiles of
+#   nodes come from a sketch, which has bounded size.
+# The samples are drawn with a generator seeded by |prefix|, so that the
+# result doesn't depend on which other cells ran before, or in parallel.
+def summarize_log(points_count, steps_bin, nodes_bin, prefix, log):
+  random = Random('37429-{}'.format(prefix))
   # Should ensure that errors >10% of sampling position happen only with Pr<1%.
   samples_count = math.ceil(
     points_count * (math.log(points_count) + math.log(1/0.01)) / (2 * 0.1))
@@ -92,20 +210,23 @@ def summarize_log(points_count, steps_bin, nodes_bin, outdir, prefix):
   samples = [None] * samples_count
   steps_histogram = defaultdict(int)
   #nodes_histogram = defaultdict(int)
+  steps_sketch, nodes_sketch = Sketch(), Sketch()
   steps_sum = steps_sum2 = steps_max = 0
   nodes_sum = nodes_sum2 = nodes_max = nodes = 1
-  for steps, nodes_delta in parse_log():
+  for steps, nodes_delta in parse_log(log):
     nodes += nodes_delta
     steps_histogram[steps // steps_bin * steps_bin] += 1
     #nodes_histogram[nodes // nodes_bin * nodes_bin] += 1
+    steps_sketch.add(steps)
+    nodes_sketch.add(nodes)
     steps_sum += steps
     nodes_sum += nodes
     steps_sum2 += steps * steps
     #nodes_sum2 += nodes * nodes
     steps_max = max(steps_max, steps)
     nodes_max = max(nodes_max, nodes)
-    if randrange(index + 1) < samples_count:
-      j = index if index < samples_count else randrange(samples_count)
+    if random.randrange(index + 1) < samples_count:
+      j = index if index < samples_count else random.randrange(samples_count)
       samples[j] = (index + 1, steps_sum, nodes_max)
     last = (index + 1, steps_sum, nodes_max)
     index += 1
@@ -120,6 +241,58 @@ def summarize_log(points_count, steps_bin, nodes_bin, outdir, prefix):
         points.append(samples[i-1])
       else:
         points.append(samples[i])
+  return make_summary(index, points, steps_histogram,
+    steps_sum, steps_sum2, steps_max, nodes_max, steps_sketch, nodes_sketch)
+
+# Summarizes the output of main -a, which has a histogram per operation type.
+# See tb_print_statistics in treebuffer.h for the format.
+# Latencies, if present, are summarized over all operations and for add_child.
+def summarize_aggregate(steps_bin, log):
+  operations = ['add_child', 'deactivate', 'history', 'delete']
+  index = steps_sum = steps_sum2 = steps_max = 0
+  nodes_max = 1
+  steps_histogram = defaultdict(int)
+  steps_sketch, nodes_sketch = Sketch(), Sketch()
+  latency_sketch, add_latency_sketch = Sketch(), Sketch()
+  for line in log:
+    words = line.split()
+    if words[0] not in operations + ['nodes'] and not words[0].endswith('_ns'):
+      continue
+    values = [tuple(map(int, w.split(':'))) for w in words[5:]]
+    if words[0].endswith('_ns'):
+      for x, n in values:
+        latency_sketch.add(x, n)
+        if words[0] == 'add_child_ns':
+          add_latency_sketch.add(x, n)
+      continue
+    if words[0] == 'nodes':
+      nodes_max = max(nodes_max, int(words[4]))
+      for x, n in values:
+        nodes_sketch.add(x, n)
+      continue
+    index += int(words[1])
+    steps_sum += int(words[2])
+    steps_sum2 += float(words[3])
+    steps_max = max(steps_max, int(words[4]))
+    for x, n in values:
+      steps_histogram[x // steps_bin * steps_bin] += n
+      steps_sketch.add(x, n)
+  points = [(0, 0, 1), (index, steps_sum, nodes_max)]
+  summary, series = make_summary(index, points, steps_histogram,
+    steps_sum, steps_sum2, steps_max, nodes_max, steps_sketch, nodes_sketch)
+  for name, sketch in \
+      [('latency', latency_sketch), ('latency-add', add_latency_sketch)]:
+    if sketch.count == 0:
+      continue
+    summary['{}-max'.format(name)] = sketch.max
+    for p, q in quantiles:
+      summary['{}-{}'.format(name, p)] = sketch.quantile(q)
+  return summary, series
+
+# Returns the summary of a cell, which has a value per key, and its series,
+# which are lists of (x, y) pairs.
+def make_summary(index, points, steps_histogram,
+    steps_sum, steps_sum2, steps_max, nodes_max, steps_sketch, nodes_sketch):
   steps_avg = steps_sum / index
   #nodes_avg = nodes_sum / index
   steps_dev = math.sqrt(steps_sum2 - steps_avg * steps_avg)
@@ -134,13 +307,11 @@ def summarize_log(points_count, steps_bin, nodes_bin, outdir, prefix):
     return bs[i][0]
   steps_med = median(steps_histogram)
   #nodes_med = median(nodes_histogram)
-  with Path(outdir, '{}-steps-freq.json'.format(prefix)).open('w') as out:
-    json.dump(steps_histogram, out)
-  with Path(outdir, '{}-steps.json'.format(prefix)).open('w') as out:
-    json.dump([(t, s) for t, s, _ in points], out)
-  with Path(outdir, '{}-nodes.json'.format(prefix)).open('w') as out:
-    json.dump([(t, n) for t, _, n in points], out)
-  return \
+  series = \
+    { 'steps-freq' : steps_histogram
+    , 'steps' : [(t, s) for t, s, _ in points]
+    , 'nodes' : [(t, n) for t, _, n in points] }
+  summary = \
     { 'steps-med' : steps_med
     , 'steps-avg' : steps_avg
     , 'steps-dev' : steps_dev
@@ -150,6 +321,11 @@ def summarize_log(points_count, steps_bin, nodes_bin, outdir, prefix):
 #    , 'nodes-avg' : nodes_avg
 #    , 'nodes-dev' : nodes_dev
     , 'nodes-max' : nodes_max }
+  # Within 1% of the exact quantiles; see sketch.py.
+  for p, q in quantiles:
+    summary['steps-{}'.format(p)] = steps_sketch.quantile(q)
+    summary['nodes-{}'.format(p)] = nodes_sketch.quantile(q)
+  return summary, series
 
 
 def data_file_stem(name):
@@ -159,44 +335,155 @@ def data_file_stem(name):
       name = name[:-len(s)]
   return name
 
-def dumpmemstats():
-  top_stats = tracemalloc.take_snapshot().statistics('lineno')
-  for s in top_stats[:20]:
-    print(s)
+def main_options(args):
+  return ['-t'] if args.timing else ['-a'] if args.aggregate else []
+
+def summarize(args, prefix, log):
+  if args.aggregate or args.timing:
+    return summarize_aggregate(args.step_bin, log)
+  return summarize_log(args.points, args.step_bin, args.node_bin, prefix, log)
+
+def setup_profiler(args):
+  profiler.setup(args.profile_python, args.profile_memory)
+
+# Returns (summary, series) of a cell, and its phase.
+def run_cell(args, trace, history, algorithm, prefix):
+  setup_profiler(args)
+  sys.stderr.write('RUN {}\n'.format(prefix))
+  sys.stderr.flush()
+  with profiler.phase('cell', top=True, cell=prefix) as phase:
+    lines = run(args.executable, trace, history, algorithm, main_options(args))
+    try:
+      result = summarize(args, prefix, lines)
+    finally:
+      lines.close()
+  return result, phase
+
+# Runs |cells| with one main, and returns their (summary, series) pairs, and
+# the phase of the group.
+def run_group(args, trace, cells):
+  setup_profiler(args)
+  prefixes = ' '.join(prefix for _, _, prefix in cells)
+  sys.stderr.write('RUN {}\n'.format(prefixes))
+  sys.stderr.flush()
+  with profiler.phase('group', top=True, cells=prefixes) as phase:
+    results = run_lockstep(args.executable, trace, cells, main_options(args),
+      lambda cell, log: summarize(args, cell[2], log))
+  return results, phase
+
+def run_one(args, trace, batch):
+  result, phase = run_cell(args, trace, *batch[0])
+  return [result], phase
+
+# Returns the (cell, (summary, series)) pairs of |batch| from |call|(), which
+# gives their results and a phase. A failure is reported, and each cell of
+# |batch| then gets None, so that it is not stored, and is run next time.
+def outcome(batch, call, adopt):
+  try:
+    results, phase = call()
+  except Exception as e:
+    sys.stderr.write('FAILED {}: {}\n'.format(
+      ' '.join(prefix for _, _, prefix in batch), e))
+    sys.stderr.flush()
+    return [(c, None) for c in batch]
+  if adopt:
+    profiler.adopt(phase)
+  return list(zip(batch, results))
+
+# Yields (cell, (summary, series)) pairs as cells finish, or (cell, None) if
+# they fail. With --lockstep, the cells are dealt round-robin to one group per
+# job. The phases of the cells that ran in other processes are adopted by the
+# profiler.
+def run_cells(args, trace, cells):
+  if args.lockstep:
+    batches = [cells[i::args.jobs] for i in range(min(args.jobs, len(cells)))]
+    run_batch = run_group
+  else:
+    batches = [[c] for c in cells]
+    run_batch = run_one
+  jobs = min(args.jobs, len(batches))
+  if jobs <= 1:
+    for b in batches:
+      yield from outcome(b, lambda: run_batch(args, trace, b), False)
+    return
+  with ProcessPoolExecutor(jobs) as pool:
+    futures = \
+      { pool.submit(run_batch, args, trace, b) : b for b in batches }
+    for f in as_completed(futures):
+      yield from outcome(futures[f], f.result, True)
 
 def main():
-  global run, summarize_log
-  seed(37429)
   args = argparser.parse_args()
   outdir = Path(args.outdir, data_file_stem(args.data))
   if not outdir.exists():
     outdir.mkdir(parents=True)
-  summarize_log = \
-    partial(summarize_log, args.points, args.step_bin, args.node_bin, outdir)
-  run = partial(run, args.executable, args.data, args.keep_history)
-  summaries = [{} for _ in range(args.history + 1)]
-  naive_summary = None
+  setup_profiler(args)
+  try:
+    failed = run_sweep(args, outdir)
+  finally:
+    profiler.save(Path(outdir, profile_file_name), command=sys.argv,
+      data=args.data, executable=args.executable)
+  if failed:
+    sys.stderr.write('E: {} cells failed: {}\n'.format(
+      len(failed), ' '.join(failed)))
+    sys.exit(1)
+
+# Returns the prefixes of the cells that failed.
+def run_sweep(args, outdir):
+  with profiler.phase('cache'):
+    trace, data_hash = cached_trace(args.data, args.keep_history,
+      args.cache_dir or Path(args.outdir, 'cache'), args.jobs)
+  # A cell is identified by the hashes of the dataset and of the executable,
+  # and by the options that change its results.
+  prefix_key = '{}-{}-{}'.format(data_hash,
+    file_hash(args.executable), json.dumps([args.points, args.step_bin,
+      args.node_bin, args.keep_history, args.aggregate, args.timing]))
+  def cell_key(history, algorithm):
+    return hashlib.sha256('{}-{}-{}'.format(
+      prefix_key, history, algorithm).encode()).hexdigest()
+  cells = []
   if 'naive' in args.algorithm:
-    run(args.history, 'naive')
-    naive_summary = summarize_log('naive')
+    cells.append((args.history, 'naive', 'naive'))
   for h in range(1, args.history + 1):
-    sys.stderr.write('HISTORY {}\n'.format(h))
-    sys.stderr.flush()
-    summaries[h]['naive'] = naive_summary
     for a in args.algorithm:
-      if a == 'naive':
+      if a != 'naive':
+        cells.append((h, a, '{}-{}'.format(a, h)))
+  with ResultStore(outdir) as store:
+    done = {} if args.rerun else store.cells()
+    todo = [(h, a, p) for h, a, p in cells if done.get(p) != cell_key(h, a)]
+    sys.stderr.write('I: {} of {} cells already done\n'.format(
+      len(cells) - len(todo), len(cells)))
+    for h, a, prefix in todo:
+      store.remove_cell(prefix)
+    # Cells outside this sweep stay, unless they are out of date.
+    for prefix, key in done.items():
+      a, _, h = prefix.rpartition('-')
+      if prefix == 'naive':
+        a, h = prefix, str(args.history)
+      if a in algorithms and h.isdigit() and key != cell_key(int(h), a):
+        store.remove_cell(prefix)
+    failed = []
+    for (h, a, prefix), result in run_cells(args, trace, todo):
+      if result is None:
+        failed.append(prefix)
         continue
-      run(h, a)
-      summaries[h][a] = summarize_log('{}-{}'.format(a, h))
-  prof_start()
-  for a in args.algorithm:
-    keys = sorted(summaries[1][a].keys())
-    for k in keys:
-      with Path(outdir, '{}-{}.json'.format(a, k)).open('w') as out:
-        json.dump(
-            [(h, summaries[h][a][k]) for h in range(1, args.history + 1)], out)
-  prof_stop('save_across_history')
-  #dumpmemstats()
+      summary, series = result
+      # naive does not depend on the history, and is run once.
+      histories = range(1, args.history + 1) if a == 'naive' else [h]
+      store.add_cell(prefix, cell_key(h, a), a, histories, summary, series)
+  if args.json:
+    with profiler.phase('save_across_history'):
+      save_json(args, outdir)
+  return failed
+
+def save_json(args, outdir):
+  series, summary = load_results(Path(outdir, ResultStore.file_name))
+  for (prefix, kind), xys in series.items():
+    with Path(outdir, '{}-{}.json'.format(prefix, kind)).open('w') as out:
+      json.dump(xys, out)
+  for (a, k), hvs in summary.items():
+    with Path(outdir, '{}-{}.json'.format(a, k)).open('w') as out:
+      json.dump([(h, v) for h, v in hvs if h <= args.history], out)
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from pathlib import Path
+from statistics import median, median_low
+from subprocess import DEVNULL, call
+from tempfile import TemporaryDirectory
+from util import algorithms, executable_path, posint
+from workload import shapes, write_trace
+
+import json
+import os
+import sys
+
+argparser = ArgumentParser(description='''\
+  Runs the algorithms of treebuffer on synthetic workloads (see workload.py),
+  and reports, for each workload, algorithm and history: operations per
+  second, memory references per operation, peak number of nodes, and peak
+  RSS of main. Only the operations are timed, by main -t, so starting main
+  and parsing the trace do not count. Each cell is run at least --repeat
+  times, and until its operations took --min-time seconds in all; the median
+  of the runs is taken.
+
+  The results go to OUTDIR/results.json. With --save-baseline they also
+  become the baseline; otherwise, if there is a baseline, each result is
+  compared with it, and those worse by more than --threshold are flagged,
+  in which case the exit status is 1. For operations per second, the
+  threshold is widened by the spread of the runs (slowest to fastest,
+  relative to the median) in the baseline or now, whichever is larger, so
+  that noise alone does not count, but at most to twice itself; a cell whose
+  spread is larger than the threshold gets a warning that it is too noisy to
+  tell. The RSS must also grow by more than 1MiB, since small processes vary
+  by a few pages.
+''', formatter_class=RawDescriptionHelpFormatter)
+
+argparser.add_argument('-w', '--workload', nargs='+', choices=sorted(shapes),
+  default=sorted(shapes),
+  help='which workloads to run')
+argparser.add_argument('-n', '--operations', type=posint, default=200000,
+  help='operations per workload (default: 200000)')
+argparser.add_argument('-s', '--seed', type=int, default=1,
+  help='seed of the workloads (default: 1)')
+argparser.add_argument('-H', '--history', type=posint, nargs='+',
+  default=[1, 4, 16, 64],
+  help='which histories to try (default: 1 4 16 64)')
+argparser.add_argument('-A', '--algorithm', nargs='+',
+  choices=algorithms, default=algorithms,
+  help='which algorithms to try')
+argparser.add_argument('-E', '--executable', type=executable_path,
+  default='./main',
+  help='executable: a path, or a command in PATH')
+argparser.add_argument('-r', '--repeat', type=posint, default=5,
+  help='runs per cell, at least; the median counts (default: 5)')
+argparser.add_argument('-m', '--min-time', type=float, default=1.0,
+  help='seconds of operations per cell, at least (default: 1)')
+argparser.add_argument('-O', '--outdir', default='bench',
+  help='where to put the workloads and results (default: bench)')
+argparser.add_argument('-B', '--baseline',
+  help='baseline file (default: OUTDIR/baseline.json)')
+argparser.add_argument('--save-baseline', action='store_true',
+  help='make these results the baseline')
+argparser.add_argument('-t', '--threshold', type=float, default=0.1,
+  help='relative change that counts as a regression (default: 0.1)')
+
+rss_slack_kib = 1024
+
+# For each metric, whether larger is better.
+metrics = {
+  'ops-per-second' : True,
+  'mems-per-op' : False,
+  'peak-nodes' : False,
+  'max-rss-kib' : False }
+
+operations = ['add_child', 'deactivate', 'history']
+
+# Reads the summary that main -t writes, and the peak RSS after it.
+def parse_summary(lines):
+  result = { 'operations' : 0, 'mems' : 0, 'ns' : 0 }
+  for line in lines:
+    words = line.split()
+    if words[0].endswith('_ns'):
+      result['ns'] += int(words[2])
+    elif words[0] == 'live':
+      result['peak-nodes'] = int(words[3])
+    elif words[0] in operations:
+      result['operations'] += int(words[1])
+      result['mems'] += int(words[2])
+    elif words[0] == 'delete':
+      result['mems'] += int(words[2])
+    elif words[0] == 'max-rss-kib':
+      result['max-rss-kib'] = int(words[1])
+  return result
+
+# Runs |executable| on |trace| once, and returns the summary of main, which
+# includes the time of the operations and its peak RSS.
+def run_once(executable, trace, history, algorithm, tmp):
+  init = Path(tmp, 'initialize')
+  init.write_text('initialize {} {} 0:-1\n'.format(history, algorithm))
+  stats = Path(tmp, 'stats')
+  returncode = call([executable, '-t', '-s', str(stats), str(init), trace],
+    stdout=DEVNULL)
+  if returncode != 0:
+    raise RuntimeError('{} exited with {}'.format(executable, returncode))
+  with stats.open() as f:
+    return parse_summary(f)
+
+def run_cell(args, trace, workload, history, algorithm, tmp):
+  times, rss = [], []
+  while len(times) < args.repeat or sum(times) < args.min_time:
+    summary = run_once(args.executable, trace, history, algorithm, tmp)
+    times.append(summary['ns'] / 1e9)
+    if 'max-rss-kib' in summary:
+      rss.append(summary['max-rss-kib'])
+  seconds = median(times)
+  n = summary['operations']
+  return { 'workload' : workload, 'algorithm' : algorithm,
+    'history' : history, 'operations' : n, 'seconds' : seconds,
+    'ops-per-second' : n / seconds if seconds else 0,
+    'ops-spread' : (max(times) - min(times)) / seconds if seconds else 0,
+    'mems-per-op' : summary['mems'] / n if n else 0,
+    'peak-nodes' : summary['peak-nodes'],
+    'max-rss-kib' : median_low(rss) if rss else None }
+
+def cell_name(r):
+  return '{} {} {}'.format(r['workload'], r['algorithm'], r['history'])
+
+# Returns the results that are worse than in |baseline| by more than
+# |threshold| (see the description above for the slack given to speed and
+# RSS), as (result, metric, old value) triples, and the results whose speed
+# is too noisy to compare, as (result, spread) pairs.
+def regressions(results, baseline, threshold):
+  old = { cell_name(r) : r for r in baseline }
+  worse, noisy = [], []
+  for r in results:
+    b = old.get(cell_name(r))
+    if b is None:
+      continue
+    for m, larger_is_better in metrics.items():
+      if r[m] is None or b[m] is None:
+        continue
+      if m == 'ops-per-second':
+        noise = max(r.get('ops-spread', 0), b.get('ops-spread', 0))
+        if noise > threshold:
+          noisy.append((r, noise))
+        bad = r[m] < b[m] * (1 - threshold - min(noise, threshold))
+      elif larger_is_better:
+        bad = r[m] < b[m] * (1 - threshold)
+      else:
+        bad = r[m] > b[m] * (1 + threshold)
+        if m == 'max-rss-kib':
+          bad = bad and r[m] > b[m] + rss_slack_kib
+      if bad:
+        worse.append((r, m, b[m]))
+  return worse, noisy
+
+def print_table(results):
+  print('{:<10} {:<10} {:>7} {:>14} {:>11} {:>10} {:>11}'.format('workload',
+    'algorithm', 'history', 'ops-per-second', 'mems-per-op', 'peak-nodes',
+    'max-rss-kib'))
+  for r in results:
+    print('{:<10} {:<10} {:>7} {:>14.0f} {:>11.2f} {:>10} {:>11}'.format(
+      r['workload'], r['algorithm'], r['history'], r['ops-per-second'],
+      r['mems-per-op'], r['peak-nodes'], r['max-rss-kib']))
+
+def main():
+  args = argparser.parse_args()
+  outdir = Path(args.outdir)
+  outdir.mkdir(parents=True, exist_ok=True)
+  baseline_path = Path(args.baseline or outdir / 'baseline.json')
+  results = []
+  with TemporaryDirectory() as tmp:
+    for w in args.workload:
+      trace = outdir / '{}-{}-{}.in'.format(w, args.operations, args.seed)
+      if not trace.exists():
+        sys.stderr.write('I: generating {}\n'.format(trace))
+        write_trace(str(trace) + '.tmp', w, args.operations, args.seed)
+        os.replace(str(trace) + '.tmp', str(trace))
+      for a in args.algorithm:
+        for h in args.history:
+          sys.stderr.write('RUN {} {} {}\n'.format(w, a, h))
+          sys.stderr.flush()
+          results.append(run_cell(args, str(trace), w, h, a, tmp))
+  with (outdir / 'results.json').open('w') as out:
+    json.dump(results, out, indent=1)
+  print_table(results)
+  if args.save_baseline:
+    with baseline_path.open('w') as out:
+      json.dump(results, out, indent=1)
+    sys.stderr.write('I: saved baseline {}\n'.format(baseline_path))
+    return
+  if not baseline_path.exists():
+    return
+  with baseline_path.open() as f:
+    worse, noisy = regressions(results, json.load(f), args.threshold)
+  for r, spread in noisy:
+    sys.stderr.write('W: {}: too noisy, ops-per-second spread {:.2f} is '
+      'more than the threshold\n'.format(cell_name(r), spread))
+  for r, m, old in worse:
+    print('REGRESSION {}: {} {:.6g} -> {:.6g}'.format(
+      cell_name(r), m, old, r[m]))
+  if worse:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
+
+# vim:sts=2:sw=2:
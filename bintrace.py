@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# Binary traces of tree buffer operations, which ../main reads as well as the
+# text commands. The format is described next to process_binary() in main.c.
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from util import algorithms
+
+import bz2
+import sys
+
+argparser = ArgumentParser(description='''\
+  Converts a trace of treebuffer commands from text to binary, or back.
+''', formatter_class=RawDescriptionHelpFormatter)
+
+argparser.add_argument('input',
+  help='file to convert (may be .bz2)')
+argparser.add_argument('output',
+  help='where to write the result (compressed if it ends in .bz2)')
+argparser.add_argument('-t', '--to-text', action='store_true',
+  help='convert from binary to text')
+
+magic = b'\x89TB\x01'
+op_initialize, op_add_child, op_deactivate, op_expand, op_history = range(1, 6)
+flush_size = 1 << 16
+
+def put_varint(buf, u):
+  while u >= 0x80:
+    buf.append(u & 0x7f | 0x80)
+    u >>= 7
+  buf.append(u)
+
+def put_int(buf, x):
+  put_varint(buf, 2 * x if x >= 0 else -2 * x - 1)
+
+# Has the same methods as TraceWriter in nfa-example/monitor.py. If the first
+# operation is initialize, its parameters go in the header.
+class BinaryTraceWriter:
+  def __init__(self, out):
+    self.out = out
+    self.buf = bytearray(magic)
+    self.started = False
+    self.last_data = 0
+
+  def start(self, has_initialize):
+    if not self.started:
+      self.started = True
+      self.buf.append(int(has_initialize))
+      return has_initialize
+    return False
+
+  def put_node(self, node_id, data):
+    put_int(self.buf, node_id)
+    put_int(self.buf, data - self.last_data)
+    self.last_data = data
+
+  def maybe_flush(self):
+    if len(self.buf) >= flush_size:
+      self.out.write(self.buf)
+      self.buf.clear()
+
+  def initialize(self, history, algorithm, root_id, root_data):
+    if not self.start(True):
+      self.buf.append(op_initialize)
+    put_varint(self.buf, history)
+    self.buf.append(algorithms.index(algorithm))
+    self.put_node(root_id, root_data)
+
+  def add_child(self, parent_id, child_id, child_data):
+    self.start(False)
+    self.buf.append(op_add_child)
+    put_int(self.buf, parent_id)
+    self.put_node(child_id, child_data)
+    self.maybe_flush()
+
+  def deactivate(self, x):
+    self.start(False)
+    self.buf.append(op_deactivate)
+    put_int(self.buf, x)
+    self.maybe_flush()
+
+  def expand(self, parent_id, children):
+    self.start(False)
+    self.buf.append(op_expand)
+    put_int(self.buf, parent_id)
+    put_varint(self.buf, len(children))
+    for child_id, child_data in children:
+      self.put_node(child_id, child_data)
+    self.maybe_flush()
+
+  def history(self, x):
+    self.start(False)
+    self.buf.append(op_history)
+    put_int(self.buf, x)
+    self.maybe_flush()
+
+  def done(self):
+    self.start(False)
+    self.out.write(self.buf)
+    self.buf.clear()
+    self.out.flush()
+
+def check(b, m):
+  if not b:
+    sys.stderr.write('E: {}\n'.format(m))
+    sys.exit(1)
+
+# Same convention as main.c: node is ID[:DATA], and DATA defaults to ID.
+def parse_node(word):
+  i, _, d = word.partition(':')
+  return int(i), int(d) if d else int(i)
+
+commands = ['initialize', 'add_child', 'deactivate', 'expand', 'history']
+
+# Like parse_enum in main.c, commands may be abbreviated.
+def parse_command(word):
+  matches = [c for c in commands if c.startswith(word)]
+  return matches[0] if len(matches) == 1 else None
+
+def text_to_binary(lines, writer):
+  for number, line in enumerate(lines, 1):
+    words = line.split()
+    if not words or words[0].startswith('#'):
+      continue
+    command = parse_command(words[0])
+    try:
+      if command == 'initialize':
+        check(words[2] in algorithms, 'bad algorithm: {}'.format(words[2]))
+        writer.initialize(int(words[1]), words[2], *parse_node(words[3]))
+      elif command == 'add_child':
+        writer.add_child(int(words[1]), *parse_node(words[2]))
+      elif command == 'deactivate':
+        writer.deactivate(int(words[1]))
+      elif command == 'expand':
+        writer.expand(int(words[1]), [parse_node(w) for w in words[2:]])
+      elif command == 'history':
+        writer.history(int(words[1]))
+      else:
+        check(False, 'line {}: unknown command {}'.format(number, words[0]))
+    except (IndexError, ValueError):
+      check(False, 'line {}: cannot parse {}'.format(number, line.strip()))
+  writer.done()
+
+# Yields the operations in |data| as text commands.
+def binary_to_text(data):
+  check(data[:len(magic)] == magic, 'not a binary trace')
+  i = len(magic)
+  last_data = 0
+  def varint():
+    nonlocal i
+    u = shift = 0
+    while True:
+      b = data[i]
+      i += 1
+      u |= (b & 0x7f) << shift
+      shift += 7
+      if b < 0x80:
+        return u
+  def integer():
+    u = varint()
+    return u >> 1 if u & 1 == 0 else -(u >> 1) - 1
+  def node():
+    nonlocal last_data
+    node_id = integer()
+    last_data += integer()
+    return '{}:{}'.format(node_id, last_data)
+  def initialize():
+    nonlocal i
+    history = varint()
+    algorithm = algorithms[data[i]]
+    i += 1
+    return 'initialize {} {} {}\n'.format(history, algorithm, node())
+  try:
+    i += 1
+    if data[i - 1] == 1:
+      yield initialize()
+    while i < len(data):
+      op = data[i]
+      i += 1
+      if op == op_initialize:
+        yield initialize()
+      elif op == op_add_child:
+        yield 'add_child {} {}\n'.format(integer(), node())
+      elif op == op_deactivate:
+        yield 'deactivate {}\n'.format(integer())
+      elif op == op_expand:
+        parent = integer()
+        children = [node() for _ in range(varint())]
+        yield 'expand {} {}\n'.format(parent, ' '.join(children))
+      elif op == op_history:
+        yield 'history {}\n'.format(integer())
+      else:
+        check(False, 'unknown opcode {}'.format(op))
+  except IndexError:
+    check(False, 'truncated binary trace')
+
+def open_file(name, mode):
+  return (bz2.open if name.endswith('.bz2') else open)(name, mode)
+
+def main():
+  args = argparser.parse_args()
+  if args.to_text:
+    with open_file(args.input, 'rb') as f:
+      data = f.read()
+    with open_file(args.output, 'wt') as out:
+      out.writelines(binary_to_text(data))
+  else:
+    with open_file(args.input, 'rt') as f:
+      with open_file(args.output, 'wb') as out:
+        text_to_binary(f, BinaryTraceWriter(out))
+
+if __name__ == '__main__':
+  main()
+
+# vim:sts=2:sw=2:
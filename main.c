@@ -1,94 +1,294 @@
+#define _POSIX_C_SOURCE 200809L // for fdopen
+
 #include <assert.h>
 #include <ctype.h>
+#include <errno.h>
+#include <limits.h>
 #include <stdbool.h>
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <sys/stat.h>
+#include <unistd.h>
 #include "treebuffer.h"
 
-// TODO: get rid of these limits
-#define buffer_size (1 << 10)
-#define active_size (1 << 20)
-#define children_size (1 << 20)
+#define min_table_size (1 << 6)
+#define block_size (1 << 20)
 
 typedef char * (*read_t)(void);
 FILE * input_file;
-read_t read;
-FILE * statistics_file;
+bool input_is_regular; // else a pipe or a terminal, read as data arrives
+read_t read_line;
+bool aggregate_statistics;
+bool time_operations;
+
+// The trace is replayed into each of the trees of |replicas|, in lockstep.
+// Without -m there is one, which takes its history and algorithm from the
+// initialize commands.
+typedef struct {
+  int history; // 0 if from the trace
+  enum algo algo;
+  FILE * statistics_file;
+  Tree * tree;
+} Replica;
+
+Replica * replicas;
+int replica_count;
+
+// The active nodes by id: open addressing with linear probing, at most half
+// full. Each id has a row of |replica_count| nodes, one per tree, in |rows|.
+// A slot is empty if its row is 0.
+typedef struct {
+  int id;
+  unsigned row;
+} Slot;
+
+Slot * active;
+size_t active_size; // a power of 2
+size_t active_count;
+
+Node ** rows; // row r (from 1) starts at rows[(r - 1) * replica_count]
+size_t row_count; // rows handed out, including free ones
+unsigned * free_rows;
+size_t free_row_count;
+
+// Scratch arrays for expand and history, grown as needed.
+Node ** children;
+int * children_id;
+int * children_data;
+unsigned * children_row;
+size_t children_size;
+
+// The current line, reused, for interactive input.
+char * line_buffer;
+size_t line_buffer_size;
+
+// Input of get_line_from_block: |block_end| bytes, of which those from
+// |block_start| are not yet returned.
+char * block;
+size_t block_capacity, block_start, block_end;
+
+void * grow(void * p, size_t n, size_t size) {
+  p = realloc(p, n * size);
+  if (!p) {
+    fprintf(stderr, "E: out of memory.\n");
+    exit(2);
+  }
+  return p;
+}
+
+// Makes room for |n| children.
+void reserve_children(size_t n) {
+  if (n <= children_size) return;
+  size_t size = children_size ? children_size : min_table_size;
+  while (size < n) size *= 2;
+  children = grow(children, size, sizeof(Node *));
+  children_id = grow(children_id, size, sizeof(int));
+  children_data = grow(children_data, size, sizeof(int));
+  children_row = grow(children_row, size, sizeof(unsigned));
+  children_size = size;
+}
+
+Node ** row_nodes(unsigned row) {
+  return rows + (size_t) (row - 1) * replica_count;
+}
+
+unsigned new_row() {
+  if (free_row_count) return free_rows[--free_row_count];
+  if ((row_count & (row_count - 1)) == 0) { // grow at powers of 2
+    size_t size = row_count ? 2 * row_count : 1;
+    rows = grow(rows, size * replica_count, sizeof(Node *));
+    free_rows = grow(free_rows, size, sizeof(unsigned));
+  }
+  return ++row_count;
+}
+
+// The first slot to probe for |node_id|. Its bits are mixed (the finalizer of
+// MurmurHash3) so that ids which differ only in their high bits, such as
+// multiples of a large power of 2, still spread over the table.
+size_t home_slot(int node_id) {
+  uint32_t h = (uint32_t) node_id;
+  h ^= h >> 16;
+  h *= 0x85ebca6bu;
+  h ^= h >> 13;
+  h *= 0xc2b2ae35u;
+  h ^= h >> 16;
+  return h & (active_size - 1);
+}
+
+size_t slot_of(int node_id) {
+  size_t i = home_slot(node_id);
+  while (active[i].row && active[i].id != node_id) {
+    i = (i + 1) & (active_size - 1);
+  }
+  return i;
+}
+
+void clear_active(size_t size) {
+  free(active);
+  active = calloc(size, sizeof(Slot));
+  if (!active) {
+    fprintf(stderr, "E: out of memory.\n");
+    exit(2);
+  }
+  active_size = size;
+  active_count = 0;
+  row_count = free_row_count = 0;
+}
+
+void put_active(int node_id, unsigned row) {
+  if (2 * (active_count + 1) > active_size) {
+    Slot * old = active;
+    size_t old_size = active_size;
+    active = calloc(2 * old_size, sizeof(Slot));
+    if (!active) {
+      fprintf(stderr, "E: out of memory.\n");
+      exit(2);
+    }
+    active_size = 2 * old_size;
+    for (size_t i = 0; i < old_size; ++i) {
+      if (old[i].row) active[slot_of(old[i].id)] = old[i];
+    }
+    free(old);
+  }
+  size_t i = slot_of(node_id);
+  assert (!active[i].row);
+  active[i].id = node_id;
+  active[i].row = row;
+  ++active_count;
+}
 
-Tree * tree;
-Node * active[active_size]; // TODO: replace by hashtable
-Node * children[children_size];
-int children_id[children_size];
-int children_data[children_size];
+unsigned get_active(int node_id) {
+  return active[slot_of(node_id)].row;
+}
+
+// Deletes by moving later slots of the same run back, so no tombstones.
+void remove_active(int node_id) {
+  size_t i = slot_of(node_id);
+  assert (active[i].row);
+  free_rows[free_row_count++] = active[i].row;
+  size_t mask = active_size - 1;
+  for (size_t j = (i + 1) & mask; active[j].row; j = (j + 1) & mask) {
+    size_t k = home_slot(active[j].id);
+    // Move j to i unless its home k is cyclically in (i, j].
+    if (i <= j ? (i < k && k <= j) : (i < k || k <= j)) continue;
+    active[i] = active[j];
+    i = j;
+  }
+  active[i].row = 0;
+  --active_count;
+}
 
 void reset() {
-  delete(tree);
-  memset(active, 0, sizeof(active));
+  for (int r = 0; r < replica_count; ++r) {
+    delete(replicas[r].tree);
+    replicas[r].tree = 0;
+  }
+  clear_active(min_table_size);
 }
 
 int check_node_id_range(int node_id) {
-  if (0 <= node_id && node_id < active_size) return 1;
-  fprintf(stderr, "W: node id outside [0..%d).\n", active_size);
-  if (active_size <= node_id) {
-    fprintf(stderr, "W: You may want to increase active_size and recompile.\n");
-  } else {
-    fprintf(stderr, "W: Please use nonnegative IDs.\n");
-  }
+  if (0 <= node_id) return 1;
+  fprintf(stderr, "W: node id %d is negative.\n", node_id);
+  fprintf(stderr, "W: Please use nonnegative IDs.\n");
   return 0;
 }
 
 int check_node_id_is_old(int node_id) {
-  if (active[node_id]) return 1;
+  if (get_active(node_id)) return 1;
   fprintf(stderr, "E: %d is not old.\n", node_id);
   return 0;
 }
 
 int check_node_id_is_new(int node_id) {
-  if (!active[node_id]) return 1;
+  if (!get_active(node_id)) return 1;
   fprintf(stderr, "E: %d is not new.\n", node_id);
   return 0;
 }
 
-Node * get_new_node(int node_id, int node_data) {
+// Returns the row of a new node for each tree, or 0.
+unsigned get_new_node(int node_id, int node_data) {
   if (!(check_node_id_range(node_id) && check_node_id_is_new(node_id))) {
     return 0;
   }
-  return active[node_id] = tb_make_node(node_data);
+  unsigned row = new_row();
+  Node ** nodes = row_nodes(row);
+  for (int r = 0; r < replica_count; ++r) {
+    Tree * t = replicas[r].tree;
+    nodes[r] = t ? tb_new_node(t, node_data) : tb_make_node(node_data);
+  }
+  put_active(node_id, row);
+  return row;
 }
 
-Node * get_old_node(int node_id) {
+unsigned get_old_node(int node_id) {
   if (!(check_node_id_range(node_id) && check_node_id_is_old(node_id))) {
     return 0;
   }
-  return active[node_id];
+  return get_active(node_id);
 }
 
 void remove_old_node(int node_id) {
   assert (check_node_id_range(node_id));
   assert (check_node_id_is_old(node_id));
-  active[node_id] = 0;
+  remove_active(node_id);
 }
 
+// The line is valid until the next call.
 char * get_line_from_file() {
-  char * buffer = calloc(buffer_size, sizeof(char));
-  assert (buffer);
-  char * r = fgets(buffer, buffer_size, input_file);
-  if (!r) {
-    free(buffer);
-    return 0;
+  ssize_t n = getline(&line_buffer, &line_buffer_size, input_file);
+  if (n < 0) return 0;
+  if (n > 0 && line_buffer[n - 1] == '\n') line_buffer[n - 1] = 0;
+  return line_buffer;
+}
+
+// Reads at most |n| bytes of |input_file| into |p|, and returns how many, 0 at
+// the end. A regular file is read through stdio, in full blocks. Anything
+// else is read with one read call, which returns what has arrived, so that a
+// producer that writes a line at a time is not kept waiting for a block.
+size_t read_input(char * p, size_t n) {
+  if (input_is_regular) return fread(p, 1, n, input_file);
+  ssize_t k;
+  do {
+    k = read(fileno(input_file), p, n);
+  } while (k < 0 && errno == EINTR);
+  return k < 0 ? 0 : (size_t) k;
+}
+
+// Makes room for |n| more bytes of input after the |block_end| already read.
+void reserve_block(size_t n) {
+  if (block_capacity - block_end < n) {
+    block_capacity = block_end + n + 1;
+    block = grow(block, block_capacity, 1);
   }
-  assert (r == buffer);
-  while (*r) ++r;
-  --r;
-  if (*r != '\n') {
-    fprintf(stderr, "E: line buffer too small.");
-    fprintf(stderr, " Increase buffer_size and recompile.\n");
-    exit(2);
-  } else {
-    *r = 0;
+}
+
+// Like get_line_from_file, but reads |input_file| in large blocks.
+char * get_line_from_block() {
+  for (;;) {
+    char * line = block + block_start;
+    char * end = block_start == block_end ? 0
+      : memchr(line, '\n', block_end - block_start);
+    if (end) {
+      *end = 0;
+      block_start = end + 1 - block;
+      return line;
+    }
+    // Keep the partial line, and read more after it.
+    if (block_start) memmove(block, line, block_end - block_start);
+    block_end -= block_start;
+    block_start = 0;
+    reserve_block(block_size);
+    size_t n = read_input(block + block_end, block_size);
+    if (n == 0) {
+      if (block_end == 0) return 0;
+      block[block_end] = 0; // the last line has no newline
+      block_start = block_end = 0;
+      return block;
+    }
+    block_end += n;
   }
-  return buffer;
 }
 
 char * get_line_with_prompt() {
@@ -99,7 +299,8 @@ char * get_line_with_prompt() {
 }
 
 char * command_list[] =
-  { "initialize", "add_child", "deactivate", "expand", "history", "help", 0 };
+  { "initialize", "add_child", "deactivate", "expand", "history", "help",
+    "checkpoint", "restore", 0 };
 char * algorithm_list[] =
   { "naive", "gc", "amortized", "real-time", 0 };
 
@@ -126,34 +327,80 @@ int parse_enum(const char * s, char * vs[]) {
   return result;
 }
 
+// Same as sscanf(*p, "%d%n", x, &n) followed by *p += n, but faster.
+bool parse_int(const char ** p, int * x) {
+  const char * q = *p;
+  while (isspace(*q)) ++q;
+  bool negative = *q == '-';
+  if (*q == '-' || *q == '+') ++q;
+  if (!isdigit(*q)) return false;
+  long long v = 0;
+  for (; isdigit(*q); ++q) {
+    if (v < LONG_MAX / 10) v = 10 * v + (*q - '0');
+  }
+  *x = (int) (negative ? -v : v);
+  *p = q;
+  return true;
+}
+
 bool parse_node(const char ** p, int * id, int * data) {
-  int n;
-  if (sscanf(*p, "%d%n", id, &n) != 1) return false;
-  *p += n;
+  if (!parse_int(p, id)) return false;
   *data = *id;
-  if (sscanf(*p, ":%d%n", data, &n) == 1) *p += n;
+  if (**p == ':') {
+    const char * q = *p + 1;
+    if (parse_int(&q, data)) *p = q;
+  }
   return true;
 }
 
+int check_history(int history) {
+  if (history <= 0) {
+    fprintf(stderr, "W: History must be posiitve.\n");
+    return 0;
+  }
+  return 1;
+}
+
+// Sets up the new tree of |x|.
+void start_tree(Replica * x) {
+  Tree * t = x->tree;
+  if (aggregate_statistics) {
+    tb_start_aggregating_statistics(t, x->statistics_file);
+    if (time_operations) tb_start_timing(t);
+  } else if (x->statistics_file) {
+    tb_start_collecting_statistics(t, x->statistics_file);
+  }
+}
+
+void run_initialize(int history, enum algo algo, int root_id, int root_data) {
+  reset();
+  if (!(check_node_id_range(root_id) && check_node_id_is_new(root_id))) {
+    fprintf(stderr, "W: Invalid root.\n");
+    return;
+  }
+  unsigned row = new_row();
+  for (int r = 0; r < replica_count; ++r) {
+    Replica * x = &replicas[r];
+    int h = x->history ? x->history : history;
+    x->tree = tb_initialize_data(h, x->history ? x->algo : algo, root_data);
+    row_nodes(row)[r] = tb_active(x->tree);
+    start_tree(x);
+  }
+  put_active(root_id, row);
+}
+
 void do_initialize(const char * p) {
   int history;
   enum algo algo;
   int root_id, root_data;
 
-  int i;
-  if (sscanf(p, "%d %n", &history, &i) < 1) {
+  const char * q = p;
+  if (!parse_int(&q, &history)) {
     fprintf(stderr, "W: Cannot parse history. Ignoring %s.\n", p);
     return;
   }
-  if (history <= 0) {
-    fprintf(stderr, "W: History must be posiitve.\n");
-    return;
-  }
-  if (history >= children_size) {
-    fprintf(stderr, "W: history too big. Increase children_size and recompile.\n");
-    return;
-  }
-  p += i;
+  if (!check_history(history)) return;
+  for (p = q; isspace(*p); ++p);
   switch(parse_enum(p, algorithm_list)) {
   case -1: return;
   case 0: algo = tb_naive; break;
@@ -168,105 +415,248 @@ void do_initialize(const char * p) {
     fprintf(stderr, "W: Cannot parse root id. Ignoring %s.\n", p);
     return;
   }
+  run_initialize(history, algo, root_id, root_data);
+}
 
-  reset();
-  Node * root = get_new_node(root_id, root_data);
-  if (!root) {
-    fprintf(stderr, "W: Invalid root.\n");
-    return;
+void run_add_child(int parent_id, int child_id, int child_data) {
+  unsigned parent = get_old_node(parent_id);
+  unsigned child = get_new_node(child_id, child_data);
+  if (!parent) fprintf(stderr, "W: Invalid parent node id.\n");
+  if (!child) fprintf(stderr, "W: Invalid child node.\n");
+  if (!parent || !child) return;
+  for (int r = 0; r < replica_count; ++r) {
+    tb_add_child(replicas[r].tree, row_nodes(parent)[r], row_nodes(child)[r]);
   }
-  tree = tb_initialize(history, algo, root);
-  if (statistics_file) tb_start_collecting_statistics(tree, statistics_file);
 }
 
 void do_add_child(const char * p) {
   int child_id, child_data;
   int parent_id;
-  int n;
 
-  if (sscanf(p, "%d%n", &parent_id, &n) != 1) {
+  if (!parse_int(&p, &parent_id)) {
     fprintf(stderr, "W: Can't parse parent id, in add_child. Ignoring %s.\n", p);
     return;
   }
-  p += n;
   if (!parse_node(&p, &child_id, &child_data)) {
     fprintf(stderr, "W: Can't parse child, in add_child. Ignoring %s.\n", p);
     return;
   }
-  Node * parent = get_old_node(parent_id);
-  Node * child = get_new_node(child_id, child_data);
-  if (!parent) fprintf(stderr, "W: Invalid parent node id.\n");
-  if (!child) fprintf(stderr, "W: Invalid child node.\n");
-  if (!parent || !child) return;
-  tb_add_child(tree, parent, child);
+  run_add_child(parent_id, child_id, child_data);
 }
 
-void do_deactivate(const char * p) {
-  int parent_id;
-  if (sscanf(p, "%d", &parent_id) != 1) {
-    fprintf(stderr, "W: Can't parse node id, in deactivate. Ignoring %s.\n", p);
-    return;
-  }
-  Node * parent = get_old_node(parent_id);
+void run_deactivate(int parent_id) {
+  unsigned parent = get_old_node(parent_id);
   if (!parent) {
     fprintf(stderr, "W: Invalid node id.\n");
     return;
   }
-  tb_deactivate(tree, parent);
+  for (int r = 0; r < replica_count; ++r) {
+    tb_deactivate(replicas[r].tree, row_nodes(parent)[r]);
+  }
   remove_old_node(parent_id);
 }
 
-void do_expand(const char * p) {
-  int i;
+void do_deactivate(const char * p) {
   int parent_id;
-  int n;
-
-  if (sscanf(p, "%d%n", &parent_id, &n) < 1) {
-    fprintf(stderr, "W: Cannot parse parent id to expand. Ignoring %s.\n", p);
+  if (!parse_int(&p, &parent_id)) {
+    fprintf(stderr, "W: Can't parse node id, in deactivate. Ignoring %s.\n", p);
     return;
   }
-  p += n;
-  i = 0;
-  for (i = 0; i < children_size && parse_node(&p, &children_id[i], &children_data[i]); ++i);
-  if (i == children_size) {
-    fprintf(stderr, "W: Too many children. Increase children_size and recompile.\n");
-  }
+  run_deactivate(parent_id);
+}
+
+// The children are in |children_id| and |children_data|; there are |i| of
+// them.
+void run_expand(int parent_id, int i) {
+  reserve_children((size_t) i + 1);
   int bad = 0;
   for (int j = 0; j < i; ++j) {
-    children[j] = get_new_node(children_id[j], children_data[j]);
-    if (!children[j]) {
+    children_row[j] = get_new_node(children_id[j], children_data[j]);
+    if (!children_row[j]) {
       fprintf(stderr, "W: The child node at index %d is invalid.\n", j);
       ++bad;
     }
   }
-  Node * parent = get_old_node(parent_id);
+  unsigned parent = get_old_node(parent_id);
   if (!parent) fprintf(stderr, "W: Invalid parent id.\n");
-  if (i == children_size || bad > 0 || !parent) {
-    for (int j = 0; j < i; ++j) if (children[j]) {
+  if (bad > 0 || !parent) {
+    for (int j = 0; j < i; ++j) if (children_row[j]) {
       remove_old_node(children_id[j]);
     }
     return;
   }
-  children[i] = 0;
-  tb_expand(tree, parent, children);
+  for (int r = 0; r < replica_count; ++r) {
+    for (int j = 0; j < i; ++j) children[j] = row_nodes(children_row[j])[r];
+    children[i] = 0;
+    tb_expand(replicas[r].tree, row_nodes(parent)[r], children);
+  }
   remove_old_node(parent_id);
 }
 
+void do_expand(const char * p) {
+  int i;
+  int parent_id;
+
+  if (!parse_int(&p, &parent_id)) {
+    fprintf(stderr, "W: Cannot parse parent id to expand. Ignoring %s.\n", p);
+    return;
+  }
+  for (i = 0; reserve_children((size_t) i + 1),
+      parse_node(&p, &children_id[i], &children_data[i]); ++i);
+  run_expand(parent_id, i);
+}
+
+void run_history(int node_id) {
+  unsigned node = get_old_node(node_id);
+  if (!node) {
+    fprintf(stderr, "W: Invalid node id.\n");
+    return;
+  }
+  for (int r = 0; r < replica_count; ++r) {
+    Tree * t = replicas[r].tree;
+    // A history is a path of live nodes, so it is no longer than either the
+    // history length or the number of live nodes, which may be much smaller.
+    long long n = tb_live_nodes(t);
+    if (n > tb_history_length(t)) n = tb_history_length(t);
+    reserve_children((size_t) n + 1);
+    tb_history(t, row_nodes(node)[r], children);
+    printf("H:");
+    for (int i = 0; children[i]; ++i) printf(" %d", tb_get_data(children[i]));
+    printf("\n");
+  }
+}
+
 void do_history(const char * p) {
   int node_id;
-  if (sscanf(p, "%d", &node_id) < 1) {
+  if (!parse_int(&p, &node_id)) {
     fprintf(stderr, "W: no node id after history command. Ignoring %s.\n", p);
     return;
   }
-  Node * node = get_old_node(node_id);
-  if (!node) {
-    fprintf(stderr, "W: Invalid node id.\n");
+  run_history(node_id);
+}
+
+// A checkpoint of main is |main_checkpoint_magic|, the ints replica_count, n
+// and the n ids of the active nodes, then one tb_checkpoint per tree, with the
+// active nodes in the same order. It is written next to |path| and then
+// renamed, so |path| always holds a whole checkpoint.
+const char main_checkpoint_magic[8] = "tbmain1\n";
+
+void run_checkpoint(const char * path) {
+  if (!replicas[0].tree) {
+    fprintf(stderr, "W: No tree to checkpoint.\n");
+    return;
+  }
+  int n = (int) active_count;
+  int * ids = grow(0, n ? n : 1, sizeof(int));
+  unsigned * rows_of = grow(0, n ? n : 1, sizeof(unsigned));
+  Node ** nodes = grow(0, n ? n : 1, sizeof(Node *));
+  int j = 0;
+  for (size_t i = 0; i < active_size; ++i) {
+    if (!active[i].row) continue;
+    ids[j] = active[i].id;
+    rows_of[j++] = active[i].row;
+  }
+  size_t length = strlen(path);
+  char * tmp = grow(0, length + 5, 1);
+  sprintf(tmp, "%s.tmp", path);
+  FILE * f = fopen(tmp, "wb");
+  int header[2] = { replica_count, n };
+  bool ok = f
+    && fwrite(main_checkpoint_magic, 1, sizeof(main_checkpoint_magic), f)
+      == sizeof(main_checkpoint_magic)
+    && fwrite(header, sizeof(int), 2, f) == 2
+    && fwrite(ids, sizeof(int), n, f) == (size_t) n;
+  for (int r = 0; ok && r < replica_count; ++r) {
+    for (j = 0; j < n; ++j) nodes[j] = row_nodes(rows_of[j])[r];
+    ok = !tb_checkpoint(replicas[r].tree, f, n, nodes);
+  }
+  if (f && fclose(f)) ok = false;
+  if (ok && rename(tmp, path)) ok = false;
+  if (!ok) {
+    fprintf(stderr, "E: Cannot write checkpoint %s.\n", path);
+    remove(tmp);
+  }
+  free(tmp);
+  free(nodes);
+  free(rows_of);
+  free(ids);
+}
+
+// Replaces the trees by those of the checkpoint at |path|, which must have as
+// many. On failure there is no tree, as before initialize.
+void run_restore(const char * path) {
+  FILE * f = fopen(path, "rb");
+  char magic[sizeof(main_checkpoint_magic)];
+  int header[2];
+  if (!f || fread(magic, 1, sizeof(magic), f) != sizeof(magic)
+      || memcmp(magic, main_checkpoint_magic, sizeof(magic))
+      || fread(header, sizeof(int), 2, f) != 2 || header[1] < 0) {
+    fprintf(stderr, "E: Cannot read checkpoint %s.\n", path);
+    if (f) fclose(f);
+    return;
+  }
+  if (header[0] != replica_count) {
+    fprintf(stderr, "E: Checkpoint %s has %d trees, not %d.\n",
+        path, header[0], replica_count);
+    fclose(f);
     return;
   }
-  tb_history(tree, node, children);
-  printf("H:");
-  for (int i = 0; children[i]; ++i) printf(" %d", tb_get_data(children[i]));
-  printf("\n");
+  int n = header[1];
+  int * ids = grow(0, n ? n : 1, sizeof(int));
+  Node ** nodes = grow(0, (size_t) (n ? n : 1) * replica_count, sizeof(Node *));
+  bool ok = fread(ids, sizeof(int), n, f) == (size_t) n;
+  reset();
+  for (int r = 0; ok && r < replica_count; ++r) {
+    Replica * x = &replicas[r];
+    x->tree = tb_restore(f, n, nodes + (size_t) r * n);
+    ok = x->tree != 0;
+  }
+  fclose(f);
+  for (int j = 0; ok && j < n; ++j) {
+    if (!(check_node_id_range(ids[j]) && check_node_id_is_new(ids[j]))) {
+      ok = false;
+      break;
+    }
+    unsigned row = new_row();
+    for (int r = 0; r < replica_count; ++r) {
+      row_nodes(row)[r] = nodes[(size_t) r * n + j];
+    }
+    put_active(ids[j], row);
+  }
+  if (ok) {
+    for (int r = 0; r < replica_count; ++r) start_tree(&replicas[r]);
+  } else {
+    fprintf(stderr, "E: Cannot read checkpoint %s.\n", path);
+    reset();
+  }
+  free(nodes);
+  free(ids);
+}
+
+// The rest of the line, without trailing spaces, or 0 if empty.
+char * parse_path(char * p) {
+  char * end = p + strlen(p);
+  while (end > p && isspace(end[-1])) --end;
+  *end = 0;
+  return *p ? p : 0;
+}
+
+void do_checkpoint(char * p) {
+  const char * path = parse_path(p);
+  if (!path) {
+    fprintf(stderr, "W: no file after checkpoint command. Ignoring.\n");
+    return;
+  }
+  run_checkpoint(path);
+}
+
+void do_restore(char * p) {
+  const char * path = parse_path(p);
+  if (!path) {
+    fprintf(stderr, "W: no file after restore command. Ignoring.\n");
+    return;
+  }
+  run_restore(path);
 }
 
 void print_help() {
@@ -276,19 +666,41 @@ void print_help() {
   printf("  deactivate NODE_ID\n");
   printf("  expand PARENT_ID NEW_ID1[:NEW_DATA1] NEW_ID2[:NEW_DATA2] ...\n");
   printf("  history NODE_ID\n");
+  printf("  checkpoint FILE\n");
+  printf("  restore FILE\n");
   printf("  help\n");
   printf("HISTORY is a positive integer\n");
   printf("ALGORITHM is one of: naive gc amortized real-time\n");
   printf("IDs and DATA are integers\n");
+  fflush(stdout);
+}
+
+// Same as parse_enum(p, command_list), which it calls unless |p| starts with
+// a whole command name, as it usually does.
+int parse_command(const char * p) {
+  int i;
+  switch (*p) {
+  case 'i': i = 0; break;
+  case 'a': i = 1; break;
+  case 'd': i = 2; break;
+  case 'e': i = 3; break;
+  case 'h': i = p[1] == 'i' ? 4 : 5; break;
+  case 'c': i = 6; break;
+  case 'r': i = 7; break;
+  default: return parse_enum(p, command_list);
+  }
+  size_t n = strlen(command_list[i]);
+  if (!strncmp(p, command_list[i], n) && (!p[n] || isspace(p[n]))) return i;
+  return parse_enum(p, command_list);
 }
 
 void process() {
   char * line;
   char * p;
-  while ((line = read())) {
+  while ((line = read_line())) {
     for (p = line; isspace(*p); ++p);
     if (!*p || *p == '#') continue;
-    int command_index = parse_enum(p, command_list);
+    int command_index = parse_command(p);
     if (command_index < 0) continue;
     while (*p && !isspace(*p)) ++p;
     while (isspace(*p)) ++p;
@@ -299,13 +711,138 @@ void process() {
     case 3: do_expand(p); break;
     case 4: do_history(p); break;
     case 5: print_help(p); break;
+    case 6: do_checkpoint(p); break;
+    case 7: do_restore(p); break;
     default:
       assert (0);
     }
-    free(line);
   }
 }
 
+// Binary traces, as written by bintrace.py, start with |binary_magic| and a
+// byte that says whether initialize parameters follow. Then come operations,
+// each a one-byte opcode followed by its arguments. Integers are zigzag
+// varints, except for the algorithm, which is a byte. A node is its id
+// followed by its data minus the data of the previous node in the file.
+//   initialize: HISTORY ALGORITHM ROOT
+//   add_child: PARENT_ID CHILD
+//   deactivate: NODE_ID
+//   expand: PARENT_ID COUNT CHILD1 ... CHILD_COUNT
+//   history: NODE_ID
+const unsigned char binary_magic[] = { 0x89, 'T', 'B', 1 };
+enum { op_initialize = 1, op_add_child, op_deactivate, op_expand, op_history };
+
+int binary_last_data;
+
+bool read_varint(unsigned * x) {
+  *x = 0;
+  for (int shift = 0; shift < 35; shift += 7) {
+    int c = getc(input_file);
+    if (c == EOF) return false;
+    *x |= (unsigned) (c & 0x7f) << shift;
+    if (!(c & 0x80)) return true;
+  }
+  return false;
+}
+
+bool read_int(int * x) {
+  unsigned u;
+  if (!read_varint(&u)) return false;
+  *x = (int) (u >> 1) ^ -(int) (u & 1);
+  return true;
+}
+
+bool read_node(int * id, int * data) {
+  int delta;
+  if (!(read_int(id) && read_int(&delta))) return false;
+  *data = binary_last_data += delta;
+  return true;
+}
+
+bool read_binary_initialize() {
+  unsigned history;
+  int algo, root_id, root_data;
+  if (!read_varint(&history)) return false;
+  if ((algo = getc(input_file)) == EOF) return false;
+  if (!read_node(&root_id, &root_data)) return false;
+  if (!check_history(history)) return true;
+  if (algo > tb_real_time) {
+    fprintf(stderr, "W: Unknown algorithm %d. Ignoring.\n", algo);
+    return true;
+  }
+  run_initialize(history, algo, root_id, root_data);
+  return true;
+}
+
+bool read_binary_expand() {
+  int parent_id;
+  unsigned count;
+  if (!(read_int(&parent_id) && read_varint(&count))) return false;
+  int i;
+  for (i = 0; (unsigned) i < count; ++i) {
+    int id, data;
+    if (!read_node(&id, &data)) return false;
+    reserve_children((size_t) i + 1);
+    children_id[i] = id;
+    children_data[i] = data;
+  }
+  run_expand(parent_id, i);
+  return true;
+}
+
+// Returns 1 if |input_file| starts with |binary_magic|, which is then
+// consumed, and 0 if it doesn't, in which case what was read is left in
+// |block| for get_line_from_block.
+int check_binary() {
+  block_start = block_end = 0;
+  reserve_block(block_size);
+  block_end = read_input(block, 1);
+  if (!block_end || (unsigned char) block[0] != binary_magic[0]) return 0;
+  block_end = 0;
+  for (size_t i = 1; i < sizeof(binary_magic); ++i) {
+    if (getc(input_file) != binary_magic[i]) {
+      fprintf(stderr, "E: Bad binary trace header.\n");
+      return -1;
+    }
+  }
+  return 1;
+}
+
+void process_binary() {
+  bool ok = true;
+  binary_last_data = 0;
+  switch (getc(input_file)) {
+  case 0: break;
+  case 1: ok = read_binary_initialize(); break;
+  default: ok = false;
+  }
+  int op;
+  while (ok && (op = getc(input_file)) != EOF) {
+    int x, y, z;
+    switch (op) {
+    case op_initialize:
+      ok = read_binary_initialize();
+      break;
+    case op_add_child:
+      if ((ok = read_int(&x) && read_node(&y, &z))) run_add_child(x, y, z);
+      break;
+    case op_deactivate:
+      if ((ok = read_int(&x))) run_deactivate(x);
+      break;
+    case op_expand:
+      ok = read_binary_expand();
+      break;
+    case op_history:
+      if ((ok = read_int(&x))) run_history(x);
+      break;
+    default:
+      fprintf(stderr, "E: Unknown opcode %d in binary trace.\n", op);
+      return;
+    }
+  }
+  if (!ok) fprintf(stderr, "E: Truncated binary trace.\n");
+}
+
 bool read_stdin = false;
 
 void set_read_stdin() {
@@ -316,11 +853,99 @@ void set_read_stdin() {
   read_stdin = true;
 }
 
+// The peak RSS of main so far, in KiB, from VmHWM in /proc/self/status, or -1
+// if there is no such line, as off Linux.
+long peak_rss_kib() {
+  long kib = -1;
+  FILE * f = fopen("/proc/self/status", "r");
+  if (!f) return kib;
+  char line[256];
+  while (fgets(line, sizeof(line), f)) {
+    if (sscanf(line, "VmHWM: %ld", &kib) == 1) break;
+  }
+  fclose(f);
+  return kib;
+}
+
+// |where| is a path (possibly of a named pipe), fd:N for an open file
+// descriptor, or none.
+FILE * open_statistics(const char * where) {
+  FILE * f;
+  if (!strcmp(where, "none")) return 0;
+  if (!strncmp(where, "fd:", 3)) {
+    f = fdopen(atoi(where + 3), "w");
+  } else {
+    f = fopen(where, "w");
+  }
+  if (!f) fprintf(stderr, "W: cannot write to %s\n", where);
+  return f;
+}
+
+// Parses HISTORY:ALGORITHM[:STATISTICS] into |x|.
+bool parse_replica(const char * spec, Replica * x) {
+  const char * p = spec;
+  if (!parse_int(&p, &x->history) || *p++ != ':' || x->history <= 0) {
+    return false;
+  }
+  size_t n = strcspn(p, ":");
+  int a;
+  for (a = 0; algorithm_list[a]; ++a) {
+    if (strlen(algorithm_list[a]) == n && !strncmp(p, algorithm_list[a], n)) {
+      break;
+    }
+  }
+  if (!algorithm_list[a]) return false;
+  x->algo = a;
+  x->statistics_file = open_statistics(p[n] ? p + n + 1 : "none");
+  x->tree = 0;
+  return true;
+}
+
+void print_usage() {
+  fprintf(stderr, "usage: main [-a] [-t] [-s STATISTICS] [-m REPLICA ...] [FILE ...]\n");
+  fprintf(stderr, "  -a writes a summary per tree, instead of a line per operation\n");
+  fprintf(stderr, "  -t also times operations; implies -a\n");
+  fprintf(stderr, "  STATISTICS is a path, fd:N, or none");
+  fprintf(stderr, " (default: treebuffer.stats); it ends with a line\n");
+  fprintf(stderr, "     max-rss-kib N, the peak RSS of main\n");
+  fprintf(stderr, "  -m HISTORY:ALGORITHM[:STATISTICS] replays each operation into\n");
+  fprintf(stderr, "     one more tree, which ignores the history and algorithm of\n");
+  fprintf(stderr, "     initialize; history prints a line per tree, and -s is unused\n");
+  fprintf(stderr, "     (default STATISTICS: none)\n");
+  fprintf(stderr, "  FILE is a text or binary trace, or - for stdin");
+  fprintf(stderr, " (default: interactive)\n");
+}
+
 int main(int argc, char * argv[]) {
-  statistics_file = fopen("treebuffer.stats", "w");
-  if (!statistics_file)
-    fprintf(stderr, "W: cannot write to treebuffer.stats\n");
-  for (int i = 1; i < argc; ++i) {
+  const char * statistics_to = "treebuffer.stats";
+  replicas = calloc(argc, sizeof(Replica));
+  int first_file = 1;
+  for (; first_file < argc; ++first_file) {
+    if (!strcmp(argv[first_file], "-a")) {
+      aggregate_statistics = true;
+    } else if (!strcmp(argv[first_file], "-t")) {
+      aggregate_statistics = time_operations = true;
+    } else if (!strcmp(argv[first_file], "-s") && first_file + 1 < argc) {
+      statistics_to = argv[++first_file];
+    } else if (!strcmp(argv[first_file], "-m") && first_file + 1 < argc) {
+      if (!parse_replica(argv[++first_file], &replicas[replica_count++])) {
+        fprintf(stderr, "E: Bad tree %s.\n", argv[first_file]);
+        print_usage();
+        return 1;
+      }
+    } else if (!strcmp(argv[first_file], "-s") || !strcmp(argv[first_file], "-m")) {
+      print_usage();
+      return 1;
+    } else {
+      break;
+    }
+  }
+  if (!replica_count) {
+    replicas[0].statistics_file = open_statistics(statistics_to);
+    replica_count = 1;
+  }
+  clear_active(min_table_size);
+  for (int i = first_file; i < argc; ++i) {
     if (strcmp(argv[i], "-")) {
       input_file = fopen(argv[i], "r");
     } else {
@@ -331,18 +956,34 @@ int main(int argc, char * argv[]) {
       fprintf(stderr, "E: Cannot process %s. Skipping.\n", argv[i]);
       continue;
     }
-    read = get_line_from_file;
-    process();
+    struct stat st;
+    input_is_regular = !fstat(fileno(input_file), &st) && S_ISREG(st.st_mode);
+    switch (check_binary()) {
+    case 0:
+      read_line = get_line_from_block;
+      process();
+      break;
+    case 1:
+      process_binary();
+      break;
+    }
     fclose(input_file);
   }
-  if (argc == 1) {
+  if (first_file == argc) {
     input_file = stdin;
-    read = get_line_with_prompt;
+    read_line = get_line_with_prompt;
     process();
     printf("\n");
   }
-  if (statistics_file) {
-    fflush(statistics_file);
-    fclose(statistics_file);
+  long rss_kib = peak_rss_kib();
+  for (int r = 0; r < replica_count; ++r) {
+    FILE * f = replicas[r].statistics_file;
+    if (!f) continue;
+    if (aggregate_statistics && replicas[r].tree) {
+      tb_print_statistics(replicas[r].tree, f);
+    }
+    if (rss_kib >= 0) fprintf(f, "max-rss-kib %ld\n", rss_kib);
+    fflush(f);
+    fclose(f);
   }
 }
@@ -2,6 +2,7 @@
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 from pathlib import Path
+from results import ResultStore, load_results
 from util import algorithms, posint
 
 import json
@@ -36,6 +37,8 @@ argparser.add_argument('--stepsmed-vs-history', action='store_true',
   help='plot: (approx) median number of steps/op versus history size')
 argparser.add_argument('--stepsmedmax-vs-history', action='store_true',
   help='plot: median and maximum number of steps/op versus history size')
+argparser.add_argument('--latency-vs-history', action='store_true',
+  help='plot: p50/p99/p99.9 wall-clock latency versus history (batch_run.py -T)')
 argparser.add_argument('--history', type=posint, default=10,
   help='for which history to generate *-vs-opcount plots')
 argparser.add_argument('--exclude-algorithm', action='append',
@@ -46,6 +49,7 @@ argparser.add_argument('--legend-location',
   help='where to place the legend')
 
 datadir = None
+results = None # (series, summary) of numpy arrays, from ResultStore
 history = None
 legend_location = None
 relabel = { 'best' : 'real-time' }
@@ -73,20 +77,43 @@ def prepare_histogram(data):
   xs = set()
   for ds in data.values():
     for x, _ in ds:
-      xs.add(x)
+      xs.add(int(x))
   step = gcd(xs) # TODO: get rid of this heuristic, by shipping step
   new_xs = list(range(min(xs), max(xs) + step, step))
   new_data = {}
   for a, ds in data.items():
-    old_ds = { k : v for k, v in ds }
+    old_ds = { int(k) : v for k, v in ds }
     # the offset of 1 is for logscale
     new_ds = { k : 1 + (old_ds[k] if k in old_ds else 0) for k in new_xs }
     new_data[a] = sorted(new_ds.items())
   return new_data
 
+# Reads the results of batch_run.py, once, if it wrote them in a ResultStore.
+def load_results_once():
+  global results
+  path = Path(datadir, ResultStore.file_name)
+  if results is None and path.exists():
+    series, summary = load_results(path)
+    results = tuple({ k : np.array(v, dtype=float) for k, v in d.items() }
+      for d in (series, summary))
+
 def load_data(kind, with_history=True):
+  load_results_once()
   data = {}
   for a in algorithms:
+    if results is not None:
+      series, summary = results
+      if not with_history:
+        key = (a, kind)
+        table = summary
+      else:
+        key = (a if a == 'naive' else '{}-{}'.format(a, history), kind)
+        table = series
+      if key not in table:
+        raise FileNotFoundError('no {} {} in {}'.format(
+          *key, Path(datadir, ResultStore.file_name)))
+      data[a] = table[key]
+      continue
     if a == 'naive' or not with_history:
       name = '{}-{}.json'.format(a, kind)
     else:
@@ -191,6 +218,27 @@ def plot_stepsmedmax_vs_history():
   plt.xlim(xmin=1)
   save_plot('stepsmedmax-vs-history')
 
+def plot_latency_vs_history(quantiles=('p50', 'p99', 'p999')):
+  styles = { 'p50' : ':', 'p99' : '-', 'p999' : '--' }
+  try:
+    data = { q : load_data('latency-{}'.format(q), with_history=False)
+      for q in quantiles }
+  except FileNotFoundError:
+    sys.stderr.write('W: no latency data (batch_run.py -T). skipping.\n')
+    return
+  for a in sorted(algorithms):
+    color = None
+    for q in quantiles:
+      ds = data[q][a]
+      l = relabel[a] if a in relabel else a
+      L, = plt.semilogy([d[0] for d in ds], [d[1] for d in ds],
+        label='{} {}'.format(l, q), linewidth=1, linestyle=styles[q],
+        color=color, alpha=0.7)
+      color = L.get_color()
+  plt.xlabel('history $h$')
+  plt.ylabel('nanoseconds per operation')
+  plt.tight_layout()
+  save_plot('latency-vs-history')
 
 def main():
   global algorithms
@@ -224,6 +272,8 @@ def main():
     plot_stepsavgdev_vs_history()
   if args.plot_all or args.stepsmedmax_vs_history:
     plot_stepsmedmax_vs_history()
+  if args.plot_all or args.latency_vs_history:
+    plot_latency_vs_history()
 
 if __name__ == '__main__':
   main()
@@ -1,21 +1,31 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
 from functools import partial
+from heapq import heappop, heappush
+from pathlib import Path
 
 import ast
 import bz2
+import codecs
+import hashlib
+import importlib
+import io
 import json
+import mmap
+import multiprocessing
+import pickle
+import queue
 import re
 import sys
+import zlib
 
 argparser = ArgumentParser(description='''\
   From an NFA description and a text file, produce a test for treebuffer.
 ''', formatter_class=RawDescriptionHelpFormatter)
 
-def write_file(s):
-  return open(s, 'w')
 def posint(t):
   r = int(t)
   if not (r > 0):
@@ -26,13 +36,45 @@ argparser.add_argument('nfa',
   help='file with the NFA')
 argparser.add_argument('text',
   help='the text to process')
-argparser.add_argument('-o', type=write_file, default=sys.stdout,
+argparser.add_argument('-o', metavar='FILE',
   help='where to write the result (default is stdout)')
 argparser.add_argument('-H', type=posint, default=10,
   help='history length')
 argparser.add_argument('-A', default='naive',
   choices=['naive', 'gc', 'amortized', 'real-time'],
   help='algorithm')
+argparser.add_argument('--direct', action='store_true',
+  help='run the tree buffer in-process (needs ../libtreebuffer.so), and write '
+  'the histories like ../main would, instead of the trace')
+argparser.add_argument('--binary', action='store_true',
+  help='write the trace in the binary format of ../bintrace.py')
+argparser.add_argument('--compact', action='store_true',
+  help='write the children a node gets in the step it is done as one expand, '
+  'and leave out nodes that can never be in a reported history')
+argparser.add_argument('--nfa-cache', metavar='DIR',
+  help='where to keep compiled NFAs (default: nfa-cache/ next to the NFA)')
+argparser.add_argument('--parametric', action='store_true',
+  help='the text is a list of events, one per line: an object key, a space, '
+  'and the letters of the event; each key gets its own monitor and tree '
+  'buffer (in-process, as with --direct), and its histories are printed '
+  'after it; a line with only a key ends the slice of that key')
+argparser.add_argument('--budget', type=posint, default=1 << 20,
+  metavar='NODES',
+  help='with --parametric, how many active nodes to keep over all slices; '
+  'past that, the slices used least recently are ended (default: 2^20)')
+argparser.add_argument('--checkpoint', metavar='FILE',
+  help='save the state of the monitor in FILE, and that of the tree buffer '
+  'in FILE.tree.0 or FILE.tree.1, every --checkpoint-every letters; if FILE '
+  'exists, first resume from it, skipping the text already done and '
+  'cutting -o back to where it was then. FILE is removed when the text is '
+  'done. Without --direct, the tree buffer is saved by ../main, through '
+  'checkpoint and restore commands in the trace; as ../main writes '
+  'FILE.tree.0 and FILE.tree.1 only when it gets to those commands, after '
+  'this is done, whoever runs ../main removes them when it is done')
+argparser.add_argument('--checkpoint-every', type=posint, default=1 << 20,
+  metavar='N', help='(default: 2^20)')
+argparser.add_argument('-j', '--jobs', type=posint, default=1,
+  help='with --parametric, split the keys among this many processes')
 
 def check(b, m):
   if not b:
@@ -80,68 +122,667 @@ def index_nfa(nfa):
         result[source][alpha].append((type, target))
   return result
 
-used_ids = set()
+# A compiled NFA has integer states, with 'start' being 0, and letters grouped
+# into classes: letters in the same class lead to the same transitions from
+# every state, and class 0 holds the letters that appear on no label. The
+# transitions on letter class c from state s are in table[s * width + c], as a
+# tuple of (relevant, target, target_is_error).
+CompiledNfa = namedtuple('CompiledNfa', 'states class_of width table')
 
-def allocate_node_id():
-  i = 0
-  while i in used_ids:
-    i += 1
-  used_ids.add(i)
-  return i
+compiled_nfa_version = 1
 
-def free_node_id(i):
-  used_ids.remove(i)
+def compile_nfa(nfa):
+  number = { 'start' : 0 }
+  for source, target, _, _ in nfa:
+    for q in (source, target):
+      if q not in number:
+        number[q] = len(number)
+  states = sorted(number, key=number.get)
+  index = index_nfa(nfa)
+  def step(q, alpha):
+    transitions = index[q][alpha] if alpha in index[q] else []
+    if transitions == []:
+      transitions = index[q][None] if None in index[q] else []
+    return tuple(
+      (type == 'relevant', number[target], target == 'error')
+      for type, target in transitions)
+  letters = sorted(set(a for q in index for a in index[q] if a is not None))
+  signatures = { tuple(step(q, None) for q in states) : 0 }
+  class_of = {}
+  for alpha in letters:
+    signature = tuple(step(q, alpha) for q in states)
+    if signature not in signatures:
+      signatures[signature] = len(signatures)
+    if signatures[signature] != 0:
+      class_of[alpha] = signatures[signature]
+  width = len(signatures)
+  table = [None] * (len(states) * width)
+  for signature, c in signatures.items():
+    for s, transitions in enumerate(signature):
+      table[s * width + c] = transitions
+  return CompiledNfa(states, class_of, width, table)
 
-def main():
-  args = argparser.parse_args()
-  out = args.o
-  nfa = index_nfa(parse_nfa(args.nfa))
-  root_id = allocate_node_id()
-  leaves = { root_id : [] }
-  error_ids = set()
-  def add_child(parent_id, child_id, child_data):
-    assert parent_id in used_ids
-    assert child_id in used_ids
-    out.write('add_child {} {}:{}\n'.format(parent_id, child_id, child_data))
-  def node_done(x):
-    assert x in used_ids
-    if x in error_ids:
-      out.write('history {}\n'.format(x))
-      error_ids.remove(x)
-    out.write('deactivate {}\n'.format(x))
-    free_node_id(x)
-  now, nxt = None, set([('start', root_id, False)])
-  open_file = bz2.open if args.text.endswith('.bz2') else open
-  with open_file(args.text, mode='rt', encoding='utf-8', errors='ignore') as f:
-    out.write('initialize {} {} {}:-1\n'.format(args.H, args.A, root_id))
-    position = -1
+# Parsing and compiling is skipped if the cache has an entry for the same
+# NFA text.
+def load_nfa(nfa_file, cache_dir=None):
+  with open(nfa_file, 'rb') as f:
+    key = hashlib.sha256(f.read()).hexdigest()
+  if cache_dir is None:
+    cache_dir = Path(nfa_file).parent / 'nfa-cache'
+  path = Path(cache_dir, '{}-{}.pickle'.format(key, compiled_nfa_version))
+  try:
+    with path.open('rb') as f:
+      return CompiledNfa(**pickle.load(f))
+  except (OSError, pickle.UnpicklingError, EOFError, TypeError):
+    pass
+  nfa = compile_nfa(parse_nfa(nfa_file))
+  try:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with tmp.open('wb') as f:
+      pickle.dump(nfa._asdict(), f, pickle.HIGHEST_PROTOCOL)
+    tmp.replace(path)
+  except OSError as e:
+    sys.stderr.write('W: cannot cache compiled NFA: {}\n'.format(e))
+  return nfa
+
+# For --compact: whether a tuple (state, node, saw_error) can still lead to a
+# history query on node or on one of its descendants. A query happens for a
+# node created by a relevant transition that is into 'error', or that follows
+# an irrelevant transition into 'error'. Returns two lists, indexed by state,
+# for saw_error false and true; both over-approximate, so pruning the tuples
+# for which they say no never changes a reported history.
+def useful_states(nfa):
+  n, width, table = len(nfa.states), nfa.width, nfa.table
+  def transitions(s):
+    for c in range(width):
+      yield from table[s * width + c]
+  def closure(s):
+    seen, todo = {s}, [s]
+    while todo:
+      for _, t, _ in transitions(todo.pop()):
+        if t not in seen:
+          seen.add(t)
+          todo.append(t)
+    return seen
+  closures = [closure(s) for s in range(n)]
+  has_relevant = [any(r for r, _, _ in transitions(s)) for s in range(n)]
+  reach_relevant = [any(has_relevant[u] for u in closures[s]) for s in range(n)]
+  has_error = [any(e and (r or reach_relevant[t]) for r, t, e in transitions(s))
+    for s in range(n)]
+  reach_error = [any(has_error[u] for u in closures[s]) for s in range(n)]
+  return reach_error, [a or b for a, b in zip(reach_error, reach_relevant)]
+
+# Node ids are recycled lowest-first, so they stay dense and fit in the fixed
+# |active| table of main.c; |peak| is the largest id ever handed out.
+class NodeIds:
+  def __init__(self):
+    self.used = set()
+    self.free = [] # heap of released ids below |fresh|
+    self.fresh = 0 # smallest id never handed out
+    self.peak = -1
+
+  def allocate(self):
+    if self.free:
+      i = heappop(self.free)
+    else:
+      i = self.fresh
+      self.fresh += 1
+      self.peak = i
+    self.used.add(i)
+    return i
+
+  def release(self, i):
+    self.used.remove(i)
+    heappush(self.free, i)
+
+  def __contains__(self, i):
+    return i in self.used
+
+# Reads the text in large blocks: plain files are memory-mapped and .bz2 files
+# are decompressed |chunk_size| bytes at a time. The blocks are decoded like
+# open(path, 'rt', encoding='utf-8', errors='ignore') would, including the
+# translation of '\r\n' and '\r' into '\n'.
+chunk_size = 1 << 20
+
+def byte_blocks(f):
+  if isinstance(f, bz2.BZ2File):
     while True:
+      block = f.read(chunk_size)
+      if not block:
+        return
+      yield block
+  size = Path(f.name).stat().st_size
+  if size == 0:
+    return
+  with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+    for i in range(0, size, chunk_size):
+      yield m[i:i + chunk_size]
+
+def text_decoder():
+  return io.IncrementalNewlineDecoder(
+    codecs.getincrementaldecoder('utf-8')(errors='ignore'), translate=True)
+
+@contextmanager
+def text_chunks(path):
+  open_file = bz2.open if path.endswith('.bz2') else open
+  with open_file(path, 'rb') as f:
+    def chunks():
+      decoder = text_decoder()
+      for block in byte_blocks(f):
+        text = decoder.decode(block)
+        if text:
+          yield text
+      text = decoder.decode(b'', final=True)
+      if text:
+        yield text
+    yield chunks()
+
+# The monitor reports its tree operations to a sink. TraceWriter writes them as
+# commands for ../main; TreeFeeder applies them to an in-process tree buffer.
+# Lines are collected and written |flush_lines| at a time.
+class TraceWriter:
+  flush_lines = 1 << 12
+
+  def __init__(self, out):
+    self.out = out
+    self.lines = []
+
+  def write(self, line):
+    self.lines.append(line)
+    if len(self.lines) >= self.flush_lines:
+      self.out.write(''.join(self.lines))
+      self.lines.clear()
+
+  def initialize(self, history, algorithm, root_id, root_data):
+    self.write('initialize {} {} {}:{}\n'.format(
+      history, algorithm, root_id, root_data))
+
+  def add_child(self, parent_id, child_id, child_data):
+    self.write('add_child {} {}:{}\n'.format(parent_id, child_id, child_data))
+
+  def expand(self, parent_id, children):
+    self.write('expand {}{}\n'.format(parent_id,
+      ''.join(' {}:{}'.format(i, d) for i, d in children)))
+
+  def history(self, x):
+    self.write('history {}\n'.format(x))
+
+  def deactivate(self, x):
+    self.write('deactivate {}\n'.format(x))
+
+  # The tree is saved by ../main, when it gets to the command.
+  def checkpoint(self, path):
+    self.write('checkpoint {}\n'.format(path))
+    self.out.write(''.join(self.lines))
+    self.lines.clear()
+    self.out.flush()
+
+  def restore(self, path, _):
+    self.write('restore {}\n'.format(path))
+
+  def done(self):
+    self.write('# done\n')
+    self.out.write(''.join(self.lines))
+    self.lines.clear()
+
+# For modules that live in the parent directory, next to ../main.
+def import_from_parent(name):
+  parent = str(Path(__file__).resolve().parent.parent)
+  if parent not in sys.path:
+    sys.path.insert(0, parent)
+  return importlib.import_module(name)
+
+class TreeFeeder:
+  def __init__(self, out):
+    self.out = out
+    self.tb = import_from_parent('treebuffer')
+    self.tree = None
+    self.nodes = {}
+
+  def initialize(self, history, algorithm, root_id, root_data):
+    root = self.tb.Node(root_data)
+    self.nodes[root_id] = root
+    self.tree = self.tb.Tree(history, algorithm, root)
+
+  def add_child(self, parent_id, child_id, child_data):
+    child = self.nodes[child_id] = self.tb.Node(child_data)
+    self.tree.add_child(self.nodes[parent_id], child)
+
+  def expand(self, parent_id, children):
+    nodes = self.tree.expand_data(
+      self.nodes.pop(parent_id), [d for _, d in children])
+    for (i, _), node in zip(children, nodes):
+      self.nodes[i] = node
+
+  def history(self, x):
+    self.out.write('H:{}\n'.format(
+      ''.join(' {}'.format(d) for d in self.tree.history(self.nodes[x]))))
+
+  def deactivate(self, x):
+    self.tree.deactivate(self.nodes.pop(x))
+
+  # Returns the ids of the active nodes, in the order of the checkpoint.
+  def checkpoint(self, path):
+    ids = list(self.nodes)
+    self.tree.checkpoint(path, [self.nodes[i] for i in ids])
+    return ids
+
+  def restore(self, path, ids):
+    self.tree, nodes = self.tb.Tree.restore(path)
+    self.nodes = dict(zip(ids, nodes))
+
+  def done(self):
+    self.tree.close()
+
+# The monitor proper: feed it the text in chunks, and it reports its tree
+# operations to |sink|. A tuple (state, node, saw_error) of the frontier says
+# that the NFA can be in |state| with |node| as the last relevant step.
+# A monitor made from the |state| of another starts where that one was, and
+# leaves the sink alone: the tree buffer is to be restored by the caller.
+class Monitor:
+  def __init__(self, nfa, sink, history, algorithm, compact=False, state=None):
+    self.nfa = nfa
+    self.sink = sink
+    self.compact = compact
+    if compact:
+      self.keep_clean, self.keep_saw = useful_states(nfa)
+    # With --compact, the children made in a step are kept in |born|, by
+    # parent, until the end of the step.
+    self.born = defaultdict(list)
+    if state is not None:
+      self.__dict__.update(state)
+      return
+    self.node_ids = NodeIds()
+    root_id = self.node_ids.allocate()
+    self.error_ids = set()
+    # |refs[x]| is the number of tuples in the frontier that point at node
+    # |x|; the node is done when that drops to 0.
+    self.refs = { root_id : 1 }
+    self.frontier = set([(0, root_id, False)])
+    self.position = -1
+    sink.initialize(history, algorithm, root_id, -1)
+
+  # What a new monitor needs to go on from here; |born| is empty between
+  # calls to feed.
+  def state(self):
+    return { k : getattr(self, k)
+      for k in ('node_ids', 'error_ids', 'refs', 'frontier', 'position') }
+
+  def add_child(self, parent_id, child_id, child_data):
+    assert parent_id in self.node_ids
+    assert child_id in self.node_ids
+    if self.compact:
+      self.born[parent_id].append((child_id, child_data))
+    else:
+      self.sink.add_child(parent_id, child_id, child_data)
+
+  def node_done(self, x, children=None):
+    assert x in self.node_ids
+    if x in self.error_ids:
+      self.sink.history(x)
+      self.error_ids.remove(x)
+    if children:
+      self.sink.expand(x, children)
+    else:
+      self.sink.deactivate(x)
+    self.node_ids.release(x)
+
+  def feed(self, text):
+    class_of, width, table = self.nfa.class_of, self.nfa.width, self.nfa.table
+    compact, sink, born = self.compact, self.sink, self.born
+    if compact:
+      keep_clean, keep_saw = self.keep_clean, self.keep_saw
+    node_ids, error_ids, refs = self.node_ids, self.error_ids, self.refs
+    add_child, node_done = self.add_child, self.node_done
+    position, nxt = self.position, self.frontier
+    for alpha in text:
       position += 1
-      alpha = f.read(1)
-      if len(alpha) != 1:
-        break
       now, nxt = nxt, set()
+      c = class_of.get(alpha, 0)
+      done = []
       for source, parent_id, saw_error in now:
-        transitions = nfa[source][alpha]
-        if transitions == []:
-          transitions = nfa[source][None]
-        for type, target in transitions:
-          if type == 'irrelevant':
-            nxt.add((target, parent_id, saw_error or target == 'error'))
-          elif type == 'relevant':
-            child_id = allocate_node_id()
-            if saw_error or target == 'error':
+        for relevant, target, is_error in table[source * width + c]:
+          if not relevant:
+            y = (target, parent_id, saw_error or is_error)
+            if compact and not (keep_saw if y[2] else keep_clean)[target]:
+              continue
+            if y not in nxt:
+              nxt.add(y)
+              refs[parent_id] += 1
+          else:
+            error = saw_error or is_error
+            if compact and not keep_clean[target]:
+              if not error:
+                continue
+              # Only its own history is needed, which is known now.
+              child_id = node_ids.allocate()
+              error_ids.add(child_id)
+              add_child(parent_id, child_id, position)
+              done.append(child_id)
+              continue
+            child_id = node_ids.allocate()
+            if error:
               error_ids.add(child_id)
             nxt.add((target, child_id, False))
+            refs[child_id] = 1
             add_child(parent_id, child_id, position)
+        refs[parent_id] -= 1
+        if refs[parent_id] == 0:
+          del refs[parent_id]
+          done.append(parent_id)
+      if born:
+        # A parent done in this step gets its children by expand.
+        expanded = set()
+        done_now = set(done)
+        for parent_id, children in born.items():
+          if parent_id in done_now:
+            node_done(parent_id, children)
+            expanded.add(parent_id)
           else:
-            assert False
-      for x in set(k for _, k, _ in now) - set(k for _, k, _ in nxt):
+            for child_id, child_data in children:
+              sink.add_child(parent_id, child_id, child_data)
+        born.clear()
+        done = [x for x in done if x not in expanded]
+      for x in done:
         node_done(x)
-    for x in set(x for _, x, _ in nxt ):
-      node_done(x)
-    assert len(error_ids) == 0
-    out.write('# done\n')
+    self.position, self.frontier = position, nxt
+
+  # Ends the text: every node left is done.
+  def finish(self):
+    for x in list(self.refs):
+      self.node_done(x)
+    self.refs.clear()
+    self.frontier = set()
+    assert len(self.error_ids) == 0
+    self.sink.done()
+
+# For --parametric: the slices of some keys, as { key : Monitor }, least
+# recently used first. A slice is ended, which reports the histories it still
+# owes, when its key says so, when its NFA has no states left, or when the
+# slices hold more than |budget| active nodes; in the last case, a later event
+# of the key starts a new slice. Histories are collected in |lines|.
+class Slicer:
+  def __init__(self, nfa, history, algorithm, compact, budget):
+    self.nfa = nfa
+    self.history = history
+    self.algorithm = algorithm
+    self.compact = compact
+    self.budget = budget
+    self.slices = OrderedDict()
+    self.cost = 0 # active nodes, plus one per slice
+    self.lines = []
+    self.started = 0
+    self.evicted = 0
+
+  class KeyedOut:
+    def __init__(self, key, lines):
+      self.key = key
+      self.lines = lines
+
+    def write(self, s):
+      self.lines.append('{} {}'.format(self.key, s))
+
+  @staticmethod
+  def slice_cost(monitor):
+    return len(monitor.node_ids.used) + 1
+
+  # The letters of an event start at |position| in the text of all the keys.
+  def event(self, key, letters, position):
+    if not letters:
+      self.end(key)
+      return
+    monitor = self.slices.get(key)
+    if monitor is None:
+      monitor = self.slices[key] = Monitor(self.nfa,
+        TreeFeeder(self.KeyedOut(key, self.lines)),
+        self.history, self.algorithm, self.compact)
+      self.started += 1
+      before = 0
+    else:
+      self.slices.move_to_end(key)
+      before = self.slice_cost(monitor)
+    monitor.position = position - 1
+    monitor.feed(letters)
+    self.cost += self.slice_cost(monitor) - before
+    if not monitor.frontier:
+      self.end(key)
+    while self.cost > self.budget and len(self.slices) > 1:
+      self.end(next(iter(self.slices)))
+      self.evicted += 1
+
+  def end(self, key):
+    monitor = self.slices.pop(key, None)
+    if monitor is not None:
+      self.cost -= self.slice_cost(monitor)
+      monitor.finish()
+
+  def close(self):
+    for key in list(self.slices):
+      self.end(key)
+
+  # Returns the histories found since the last call.
+  def take(self):
+    result = ''.join(self.lines)
+    self.lines.clear()
+    return result
+
+# Yields the events of a --parametric text, as lists of (key, letters,
+# position), a block at a time.
+def parametric_events(chunks):
+  rest, position = '', 0
+  for chunk in chunks:
+    lines = (rest + chunk).split('\n')
+    rest = lines.pop()
+    events = []
+    for line in lines:
+      key, _, letters = line.partition(' ')
+      if key:
+        events.append((key, letters, position))
+        position += len(letters)
+    yield events
+  if rest:
+    key, _, letters = rest.partition(' ')
+    yield [(key, letters, position)]
+
+def shard_of(key, jobs):
+  return zlib.crc32(key.encode()) % jobs
+
+# A worker of --parametric -j: gets lists of events from |inbox| until None,
+# and answers each with the histories found.
+def run_shard(slicer, inbox, outbox):
+  while True:
+    events = inbox.get()
+    if events is None:
+      break
+    for event in events:
+      slicer.event(*event)
+    outbox.put(slicer.take())
+  slicer.close()
+  outbox.put((slicer.take(), slicer.started, slicer.evicted))
+
+# The next answer of shard |i|. Stops, rather than wait forever, if a worker
+# died, say killed for lack of memory: one that failed can never answer, and
+# one that ended can't either if it did not answer first.
+def shard_answer(i, outboxes, workers):
+  while True:
+    alive = workers[i].is_alive() # if not, what it sent is in its outbox
+    try:
+      return outboxes[i].get(timeout=1)
+    except queue.Empty:
+      for j, w in enumerate(workers):
+        check(not w.exitcode and (alive or j != i),
+          'shard {} of --parametric died, with exit code {}'.format(
+          j, w.exitcode))
+
+# The histories are printed a block of events at a time, for each shard in
+# turn, so the output depends on --jobs but is the same from run to run. The
+# next block is sent to the shards before the answers for the last one are
+# waited for.
+def run_parametric(args, nfa, chunks):
+  jobs = args.jobs
+  slicers = [Slicer(nfa, args.H, args.A, args.compact, max(1, args.budget // jobs))
+    for _ in range(jobs)]
+  if jobs == 1:
+    slicer = slicers[0]
+    for events in parametric_events(chunks):
+      for event in events:
+        slicer.event(*event)
+      args.o.write(slicer.take())
+    slicer.close()
+    args.o.write(slicer.take())
+    return slicer.started, slicer.evicted
+  context = multiprocessing.get_context('fork')
+  inboxes = [context.Queue() for _ in range(jobs)]
+  outboxes = [context.Queue() for _ in range(jobs)]
+  workers = [context.Process(target=run_shard, args=shard, daemon=True)
+    for shard in zip(slicers, inboxes, outboxes)]
+  for w in workers:
+    w.start()
+  pending = False
+  for events in parametric_events(chunks):
+    shards = [[] for _ in range(jobs)]
+    for event in events:
+      shards[shard_of(event[0], jobs)].append(event)
+    for inbox, shard in zip(inboxes, shards):
+      inbox.put(shard)
+    if pending:
+      for i in range(jobs):
+        args.o.write(shard_answer(i, outboxes, workers))
+    pending = True
+  for inbox in inboxes:
+    inbox.put(None)
+  if pending:
+    for i in range(jobs):
+      args.o.write(shard_answer(i, outboxes, workers))
+  started = evicted = 0
+  for i in range(jobs):
+    lines, s, e = shard_answer(i, outboxes, workers)
+    args.o.write(lines)
+    started += s
+    evicted += e
+  for w in workers:
+    w.join()
+  return started, evicted
+
+# For --checkpoint. The state of the tree buffer alternates between two files,
+# so that the one the state of the monitor names is always whole; the other
+# is removed before it is written again, so that a checkpoint that ../main
+# did not get to can't be mistaken for an older one.
+checkpoint_version = 1
+
+def save_checkpoint(path, args, monitor, sink, generation):
+  tree_path = '{}.tree.{}'.format(path, generation % 2)
+  try:
+    Path(tree_path).unlink()
+  except FileNotFoundError:
+    pass
+  state = { 'version' : checkpoint_version, 'history' : args.H,
+    'algorithm' : args.A, 'compact' : args.compact, 'direct' : args.direct,
+    'generation' : generation, 'tree' : tree_path,
+    'sink' : sink.checkpoint(tree_path), 'monitor' : monitor.state() }
+  args.o.flush()
+  state['output_size'] = args.o.tell() if args.o.seekable() else None
+  tmp = Path(path + '.tmp')
+  with tmp.open('wb') as f:
+    pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+  tmp.replace(path)
+
+def load_checkpoint(path, args):
+  with open(path, 'rb') as f:
+    state = pickle.load(f)
+  check(state.get('version') == checkpoint_version,
+    'checkpoint {} is from another version'.format(path))
+  for k, v in (('history', args.H), ('algorithm', args.A),
+      ('compact', args.compact), ('direct', args.direct)):
+    check(state[k] == v, 'checkpoint {} has {} {}, not {}'.format(
+      path, k, state[k], v))
+  return state
+
+def remove_checkpoint(path):
+  for p in (path, path + '.tree.0', path + '.tree.1'):
+    try:
+      Path(p).unlink()
+    except FileNotFoundError:
+      pass
+
+# Drops the first |count| letters of |chunks|.
+def skip_letters(chunks, count):
+  for chunk in chunks:
+    if count >= len(chunk):
+      count -= len(chunk)
+      continue
+    yield chunk[count:]
+    count = 0
+
+def main():
+  args = argparser.parse_args()
+  state = None
+  if args.checkpoint is not None:
+    if args.parametric or args.binary:
+      argparser.error('--checkpoint works with text traces and --direct')
+    if Path(args.checkpoint).exists():
+      state = load_checkpoint(args.checkpoint, args)
+  if args.o is None:
+    out = args.o = sys.stdout
+  elif state is None:
+    out = args.o = open(args.o, 'w')
+  else:
+    # What was written after the checkpoint is written again.
+    out = args.o = open(args.o, 'r+')
+    if state['output_size'] is not None:
+      out.truncate(state['output_size'])
+    out.seek(0, io.SEEK_END)
+  if args.parametric:
+    if args.binary:
+      argparser.error('--parametric needs an in-process tree buffer')
+    nfa = load_nfa(args.nfa, args.nfa_cache)
+    with text_chunks(args.text) as chunks:
+      started, evicted = run_parametric(args, nfa, chunks)
+    out.flush()
+    sys.stderr.write('I: {} slices, {} evicted\n'.format(started, evicted))
+    return
+  if args.direct:
+    sink = TreeFeeder(out)
+  elif args.binary:
+    sink = import_from_parent('bintrace').BinaryTraceWriter(out.buffer)
+  else:
+    sink = TraceWriter(out)
+  nfa = load_nfa(args.nfa, args.nfa_cache)
+  with text_chunks(args.text) as chunks:
+    if state is None:
+      monitor = Monitor(nfa, sink, args.H, args.A, args.compact)
+      generation = 0
+    else:
+      monitor = Monitor(nfa, sink, args.H, args.A, args.compact,
+        state['monitor'])
+      sink.restore(state['tree'], state['sink'])
+      generation = state['generation'] + 1
+      chunks = skip_letters(chunks, monitor.position + 1)
+      sys.stderr.write('I: resuming at letter {}\n'.format(monitor.position + 1))
+    if args.checkpoint is None:
+      for chunk in chunks:
+        monitor.feed(chunk)
+    else:
+      # A checkpoint is saved only once more text comes, so none is left for
+      # ../main to write after the text is done.
+      every = args.checkpoint_every
+      next_at = monitor.position + 1 + every
+      for chunk in chunks:
+        i = 0
+        while i < len(chunk):
+          if monitor.position + 1 == next_at:
+            save_checkpoint(args.checkpoint, args, monitor, sink, generation)
+            generation += 1
+            next_at += every
+          j = i + min(len(chunk) - i, next_at - (monitor.position + 1))
+          monitor.feed(chunk[i:j])
+          i = j
+    monitor.finish()
+  out.flush()
+  if args.checkpoint is not None:
+    remove_checkpoint(args.checkpoint)
+  sys.stderr.write('I: peak node id {}\n'.format(monitor.node_ids.peak))
 
 if __name__ == '__main__':
   main()
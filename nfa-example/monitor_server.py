@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from functools import partial
+from pathlib import Path
+
+from monitor import Monitor, TreeFeeder, load_nfa, posint, text_decoder
+
+import asyncio
+import json
+import stat
+import sys
+import time
+
+argparser = ArgumentParser(description='''\
+  Monitors many text streams at once. Each client that connects to SOCKET
+  sends a text, and gets back the histories that ./monitor.py --direct would
+  print for it, as they are found; the connection is closed when the text
+  ends. Every stream has its own monitor and tree buffer (in-process, so this
+  needs ../libtreebuffer.so).
+
+  A stream is read at most QUEUE blocks ahead of the monitor, after which the
+  client is left waiting. The blocks that are waiting when the monitor gets
+  to a stream, up to BATCH bytes, are processed together, and the histories
+  they give are sent together.
+
+  Counters (streams, bytes, operations, histories, queue depth, and rates
+  since the start) are written as one JSON line to each client of the
+  --stats socket.
+''', formatter_class=RawDescriptionHelpFormatter)
+
+argparser.add_argument('nfa',
+  help='file with the NFA')
+argparser.add_argument('socket',
+  help='Unix socket to listen on')
+argparser.add_argument('-H', type=posint, default=10,
+  help='history length')
+argparser.add_argument('-A', default='naive',
+  choices=['naive', 'gc', 'amortized', 'real-time'],
+  help='algorithm')
+argparser.add_argument('--compact', action='store_true',
+  help='as for ./monitor.py')
+argparser.add_argument('--stats', metavar='SOCKET',
+  help='Unix socket on which to give the counters')
+argparser.add_argument('--queue', type=posint, default=16,
+  help='blocks read ahead per stream (default: 16)')
+argparser.add_argument('--batch', type=posint, default=1 << 18,
+  help='bytes processed per stream at a time, at most (default: 256KiB)')
+argparser.add_argument('--nfa-cache', metavar='DIR',
+  help='as for ./monitor.py')
+
+block_size = 1 << 16
+
+class Counters:
+  def __init__(self):
+    self.start = time.monotonic()
+    self.streams_open = 0
+    self.streams_total = 0
+    self.bytes = 0 # received
+    self.characters = 0 # processed by the monitors
+    self.operations = 0 # on the tree buffers
+    self.histories = 0
+    self.batches = 0
+    self.queued_blocks = 0
+    self.queued_bytes = 0
+    self.queued_bytes_max = 0
+
+  def queued(self, blocks, size):
+    self.queued_blocks += blocks
+    self.queued_bytes += size
+    self.queued_bytes_max = max(self.queued_bytes_max, self.queued_bytes)
+
+  def snapshot(self):
+    seconds = time.monotonic() - self.start
+    result = dict(vars(self), seconds=seconds)
+    del result['start']
+    for k in ('bytes', 'characters', 'operations', 'histories'):
+      result[k + '-per-second'] = result[k] / seconds if seconds else 0
+    return { k.replace('_', '-') : v for k, v in result.items() }
+
+# A TreeFeeder that keeps the histories, to be sent a batch at a time, and
+# counts what it does.
+class StreamFeeder(TreeFeeder):
+  def __init__(self, counters):
+    super().__init__(self)
+    self.counters = counters
+    self.lines = []
+
+  def write(self, line):
+    self.lines.append(line)
+
+  def add_child(self, parent_id, child_id, child_data):
+    self.counters.operations += 1
+    super().add_child(parent_id, child_id, child_data)
+
+  def expand(self, parent_id, children):
+    self.counters.operations += 1
+    super().expand(parent_id, children)
+
+  def history(self, x):
+    self.counters.operations += 1
+    self.counters.histories += 1
+    super().history(x)
+
+  def deactivate(self, x):
+    self.counters.operations += 1
+    super().deactivate(x)
+
+  # Returns the histories found since the last call.
+  def take(self):
+    result = ''.join(self.lines)
+    self.lines.clear()
+    return result
+
+# Moves blocks from |reader| to |queue|: b'' when the text ends, or None if the
+# connection is lost. A full queue stops the reading, so the client waits.
+async def receive(reader, queue, counters):
+  try:
+    while True:
+      block = await reader.read(block_size)
+      counters.bytes += len(block)
+      await queue.put(block)
+      counters.queued(1, len(block))
+      if not block:
+        return
+  except ConnectionError:
+    await queue.put(None)
+    counters.queued(1, 0)
+
+async def monitor_stream(args, nfa, counters, reader, writer):
+  counters.streams_open += 1
+  counters.streams_total += 1
+  queue = asyncio.Queue(args.queue)
+  receiver = asyncio.ensure_future(receive(reader, queue, counters))
+  feeder = StreamFeeder(counters)
+  monitor = Monitor(nfa, feeder, args.H, args.A, args.compact)
+  decoder = text_decoder()
+  try:
+    while True:
+      blocks = [await queue.get()]
+      size = len(blocks[0] or b'')
+      while blocks[-1] and size < args.batch and not queue.empty():
+        blocks.append(queue.get_nowait())
+        size += len(blocks[-1] or b'')
+      counters.queued(-len(blocks), -size)
+      if blocks[-1] is None:
+        return
+      end = not blocks[-1]
+      text = decoder.decode(b''.join(blocks), final=end)
+      monitor.feed(text)
+      counters.characters += len(text)
+      counters.batches += 1
+      if end:
+        monitor.finish()
+      histories = feeder.take()
+      if histories:
+        writer.write(histories.encode())
+        await writer.drain()
+      if end:
+        return
+      # Let the other streams have their turn.
+      await asyncio.sleep(0)
+  except ConnectionError:
+    pass
+  finally:
+    receiver.cancel()
+    feeder.tree.close()
+    while not queue.empty():
+      counters.queued(-1, -len(queue.get_nowait() or b''))
+    counters.streams_open -= 1
+    writer.close()
+
+async def give_stats(counters, reader, writer):
+  writer.write((json.dumps(counters.snapshot(), sort_keys=True) + '\n').encode())
+  try:
+    await writer.drain()
+  except ConnectionError:
+    pass
+  writer.close()
+
+# A socket file left behind by an earlier server is removed.
+def remove_stale_socket(path):
+  try:
+    if stat.S_ISSOCK(Path(path).stat().st_mode):
+      Path(path).unlink()
+  except FileNotFoundError:
+    pass
+
+async def serve(args, nfa):
+  counters = Counters()
+  servers = []
+  remove_stale_socket(args.socket)
+  servers.append(await asyncio.start_unix_server(
+    partial(monitor_stream, args, nfa, counters), path=args.socket))
+  if args.stats:
+    remove_stale_socket(args.stats)
+    servers.append(await asyncio.start_unix_server(
+      partial(give_stats, counters), path=args.stats))
+  sys.stderr.write('I: listening on {}\n'.format(args.socket))
+  await asyncio.gather(*(s.serve_forever() for s in servers))
+
+def main():
+  args = argparser.parse_args()
+  nfa = load_nfa(args.nfa, args.nfa_cache)
+  try:
+    asyncio.run(serve(args, nfa))
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for path in (args.socket, args.stats):
+      if path is not None:
+        remove_stale_socket(path)
+
+if __name__ == '__main__':
+  main()
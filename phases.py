@@ -0,0 +1,189 @@
+# Where the time and memory of batch_run.py go. A phase is a named stretch of
+# work, such as the run of one cell; phases nest, also across threads (the one
+# that feeds main, and the ones that read its statistics), and a phase may be
+# entered again inside itself. Each phase is recorded as a dict:
+#   name, and labels such as cell
+#   wall, cpu, thread-cpu: seconds; cpu is of the whole process
+#   phases: the phases inside it
+#   children: resource usage of the processes it ran (see add_child), with
+#     their peak RSS as they report it
+#   other counters, such as pipe-wait (see open_timed)
+# With python=True, a phase that is outermost in its thread also has
+#   python: the functions with the most cumulative time, from cProfile
+# With memory=True, every phase also has
+#   memory-peak, memory-end: bytes allocated by Python (all threads), from
+#     tracemalloc, at most while the phase ran and at its end
+# and a phase with no parent has memory-top, the lines that hold most of it.
+# The phases with no parent are written as JSON by save.
+
+from contextlib import contextmanager
+from threading import Lock, local
+from time import perf_counter, process_time, thread_time
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import tracemalloc
+
+class Profiler:
+  def __init__(self):
+    self.python = False
+    self.memory = False
+    self.phases = [] # those with no parent, when they end
+    self.local = local()
+    self.lock = Lock()
+    self.open = [] # phases of all threads, for memory-peak
+
+  # Turning profiling on is idempotent, so that processes started by fork,
+  # which inherit the profiler, can do it again.
+  def setup(self, python=False, memory=False):
+    self.python = python
+    self.memory = memory
+    if memory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def stack(self):
+    if not hasattr(self.local, 'stack'):
+      self.local.stack = []
+    return self.local.stack
+
+  # The phase that the current thread is in, or None.
+  def current(self):
+    stack = self.stack()
+    return stack[-1] if stack else None
+
+  # Records the largest allocation so far in the phases that are open.
+  def fold_memory_peak(self):
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for p in self.open:
+      p['memory-peak'] = max(p.get('memory-peak', 0), peak)
+
+  # A phase inside |parent|, which by default is the current phase of this
+  # thread; with top=True, it has no parent.
+  @contextmanager
+  def phase(self, name, parent=None, top=False, **labels):
+    stack = self.stack()
+    if parent is None and not top and stack:
+      parent = stack[-1]
+    record = dict(name=name, **labels)
+    record['phases'] = []
+    profile = None
+    if self.python and not stack:
+      profile = cProfile.Profile()
+    if self.memory:
+      with self.lock:
+        self.fold_memory_peak()
+        self.open.append(record)
+    stack.append(record)
+    start = perf_counter(), process_time(), thread_time()
+    if profile:
+      try:
+        profile.enable()
+      except ValueError: # another thread is profiled, and Python allows one
+        profile = None
+    try:
+      yield record
+    finally:
+      if profile:
+        profile.disable()
+      end = perf_counter(), process_time(), thread_time()
+      stack.pop()
+      for k, a, b in zip(['wall', 'cpu', 'thread-cpu'], start, end):
+        record[k] = b - a
+      if profile:
+        record['python'] = top_functions(profile)
+      if self.memory:
+        with self.lock:
+          self.fold_memory_peak()
+          self.open.remove(record)
+        record['memory-end'] = tracemalloc.get_traced_memory()[0]
+        if parent is None:
+          record['memory-top'] = top_lines(tracemalloc.take_snapshot())
+      if parent is not None:
+        parent['phases'].append(record)
+      else:
+        self.phases.append(record)
+        sys.stderr.write('{:5.01f} {:5.01f} {}\n'.format(
+          record['wall'], record['cpu'], describe(record)))
+        sys.stderr.flush()
+
+  # Adds |phase|, which ended in another process, to those with no parent.
+  def adopt(self, phase):
+    self.phases.append(phase)
+
+  # Adds the resource usage |usage| (from os.wait4) of the process |command|,
+  # and its peak RSS |max_rss_kib| if known, to the current phase. The
+  # ru_maxrss of |usage| is not used: it counts what the parent had before
+  # the exec.
+  def add_child(self, command, usage, max_rss_kib=None):
+    phase = self.current()
+    if phase is None:
+      return
+    child = { 'command' : command
+      , 'user' : usage.ru_utime
+      , 'system' : usage.ru_stime }
+    if max_rss_kib is not None:
+      child['max-rss-kib'] = max_rss_kib
+    phase.setdefault('children', []).append(child)
+
+  def save(self, path, **info):
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as out:
+      json.dump(dict(info, phases=self.phases), out, indent=1)
+    os.replace(tmp, str(path))
+
+def describe(phase):
+  return ' '.join([phase['name']] + [phase[k] for k in ('cell', 'cells')
+    if k in phase])
+
+def top_functions(profile, count=25):
+  stats = pstats.Stats(profile).stats
+  rows = sorted(stats.items(), key=lambda kv: -kv[1][3])[:count]
+  return [
+    { 'function' : '{}:{}({})'.format(*where)
+    , 'calls' : calls
+    , 'primitive-calls' : primitive_calls
+    , 'own' : own
+    , 'cumulative' : cumulative }
+    for where, (primitive_calls, calls, own, cumulative, _) in rows ]
+
+def top_lines(snapshot, count=20):
+  return [
+    { 'line' : '{}:{}'.format(s.traceback[0].filename, s.traceback[0].lineno)
+    , 'size' : s.size
+    , 'count' : s.count }
+    for s in snapshot.statistics('lineno')[:count] ]
+
+# The read end |fd| of a pipe, as a text file, which adds the time spent
+# waiting for data to phase[key].
+def open_timed(fd, phase, key, buffering):
+  return io.TextIOWrapper(io.BufferedReader(TimedReader(fd, phase, key),
+    buffering))
+
+class TimedReader(io.RawIOBase):
+  def __init__(self, fd, phase, key):
+    self.file = io.FileIO(fd, 'rb')
+    self.phase = phase
+    self.key = key
+    phase.setdefault(key, 0)
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    start = perf_counter()
+    n = self.file.readinto(b)
+    self.phase[self.key] += perf_counter() - start
+    return n
+
+  def close(self):
+    self.file.close()
+    super().close()
+
+profiler = Profiler()
+
+# vim:sts=2:sw=2:
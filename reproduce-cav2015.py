@@ -1,48 +1,64 @@
 #!/usr/bin/env python3
 
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 from subprocess import PIPE, Popen, STDOUT
+from threading import Lock
 from urllib.request import urlopen
 
 import os
 import sys
 
+argparser = ArgumentParser(description='''\
+  Downloads the datasets, runs the experiments, and makes the plots of the
+  paper. Work already done is kept: batch_run.py keeps the cells it finished,
+  so an interrupted run can simply be started again.
+''', formatter_class=RawDescriptionHelpFormatter)
+
+argparser.add_argument('-j', '--jobs', type=int, default=2,
+  help='how many steps (downloads, experiments, plots) to run at once')
+
 server_url = 'https://s3-eu-west-1.amazonaws.com/tree-buffers/datasets'
+datasets = [ "chain", "dacapo-hasnext", "wikipedia" ]
+
+output_lock = Lock()
+
+def say(s):
+  with output_lock:
+    sys.stdout.write(s)
+    sys.stdout.flush()
 
 def download_dataset(dataset):
   os.makedirs('datasets', exist_ok=True)
   url = '{}/{}.in.bz2'.format(server_url, dataset)
   path = 'datasets/{}.in.bz2'.format(dataset)
   if Path(path).exists():
-    sys.stdout.write('  file {} exists, not downloading\n'.format(path))
+    say('  file {} exists, not downloading\n'.format(path))
     return
+  tmp = path + '.part'
   with urlopen(url) as r:
     file_size = int(r.getheader("Content-Length"))
-    sys.stdout.write('  downloading {}\n    (takes 20 #s to finish)\n'.format(url))
-    sys.stdout.write('    {:.1f}MiB: '.format(file_size/2**20))
-    sys.stdout.flush()
-    with open(path, 'wb') as w:
+    say('  downloading {} ({:.1f}MiB)\n'.format(url, file_size/2**20))
+    with open(tmp, 'wb') as w:
       while True:
         buffer = r.read(file_size // 20 + 1)
         if not buffer:
           break
         w.write(buffer)
-        sys.stdout.write('#')
-        sys.stdout.flush()
-  sys.stdout.write('\n')
+  os.replace(tmp, path)
+  say('  downloaded {}\n'.format(path))
 
 def run(command):
-  sys.stdout.write('    executing command: {}\n'.format(' '.join(command)))
+  say('    executing command: {}\n'.format(' '.join(command)))
   with Popen(command, stdout=PIPE, stderr=STDOUT, bufsize=0, universal_newlines=True) as p:
     for line in p.stdout:
-      sys.stdout.write('      {}'.format(line))
-      sys.stdout.flush()
+      say('      {}'.format(line))
+  if p.returncode != 0:
+    raise RuntimeError('{} exited with {}'.format(command[0], p.returncode))
 
 def batch_run(dataset):
-  if Path('logs/datasets/{}'.format(dataset)).exists():
-    sys.stdout.write('  logs/datasets/{} exists, not running batch_run.py\n'.format(dataset))
-    return
-  sys.stdout.write('  running experiments and summarizing logs\n')
+  say('  running experiments and summarizing logs for {}\n'.format(dataset))
   command = \
     [ './batch_run.py'
     , 'datasets/{}.in.bz2'.format(dataset)
@@ -51,25 +67,71 @@ def batch_run(dataset):
     , '-E', './main' ]
   run(command)
 
-def make_plots(dataset):
+plots =\
+  [ ( 'stepsavg-vs-history', [], 'runtime' )
+  , ( 'stepsavg-vs-history', ['--exclude-algorithm', 'gc'], 'runtime-nogc' )
+  , ( 'steps-frequency', ['--history', '100'], 'runtime-perop')
+  , ( 'nodesmax-vs-history', ['--exclude-algorithm', 'naive'], 'memory') ]
+
+def make_plot(dataset, a, bs, c):
   os.makedirs('plots', exist_ok=True)
-  todo =\
-    [ ( 'stepsavg-vs-history', [], 'runtime' )
-    , ( 'stepsavg-vs-history', ['--exclude-algorithm', 'gc'], 'runtime-nogc' )
-    , ( 'steps-frequency', ['--history', '100'], 'runtime-perop')
-    , ( 'nodesmax-vs-history', ['--exclude-algorithm', 'naive'], 'memory') ]
-  sys.stdout.write('  making plots\n')
-  for a, bs, c in todo:
-    run(['./make_plots.py', '--{}'.format(a), 'logs/datasets/{}'.format(dataset)] + bs)
-    run(['cp', 'logs/datasets/{}/{}.png'.format(dataset, a), 'plots/{}-{}.png'.format(dataset, c)])
+  run(['./make_plots.py', '--{}'.format(a), 'logs/datasets/{}'.format(dataset)] + bs)
+  run(['cp', 'logs/datasets/{}/{}.png'.format(dataset, a), 'plots/{}-{}.png'.format(dataset, c)])
+
+# The steps, as { name : (dependencies, function) }. Plots that write the
+# same file under logs/ depend on each other, so they don't run at once.
+def make_steps():
+  steps = { 'make' : ([], lambda: run(['make'])) }
+  for d in datasets:
+    steps['download ' + d] = ([], lambda d=d: download_dataset(d))
+    steps['run ' + d] = \
+      (['make', 'download ' + d], lambda d=d: batch_run(d))
+    last_writer = {}
+    for a, bs, c in plots:
+      name = 'plot {} {}'.format(d, c)
+      deps = ['run ' + d] + ([last_writer[a]] if a in last_writer else [])
+      steps[name] = (deps, lambda d=d, a=a, bs=bs, c=c: make_plot(d, a, bs, c))
+      last_writer[a] = name
+  return steps
+
+# Runs |steps| with at most |jobs| at once, each as soon as its dependencies
+# are done. A step that fails is reported, and the steps that depend on it are
+# skipped. Returns the names of the steps that did not succeed.
+def run_steps(steps, jobs):
+  done, failed = set(), set()
+  pending = dict(steps)
+  running = {}
+  with ThreadPoolExecutor(jobs) as pool:
+    while pending or running:
+      for name, (deps, f) in list(pending.items()):
+        if any(d in failed for d in deps):
+          say('skipping {}\n'.format(name))
+          failed.add(name)
+          del pending[name]
+        elif all(d in done for d in deps) and len(running) < jobs:
+          say('starting {}\n'.format(name))
+          running[pool.submit(f)] = name
+          del pending[name]
+      if not running:
+        break
+      finished, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in finished:
+        name = running.pop(future)
+        try:
+          future.result()
+          done.add(name)
+          say('finished {}\n'.format(name))
+        except Exception as e:
+          failed.add(name)
+          say('FAILED {}: {}\n'.format(name, e))
+  return set(steps) - done
 
 def main():
-  run(['make'])
-  for d in [ "chain", "dacapo-hasnext", "wikipedia" ]:
-    sys.stdout.write('processing {}\n'.format(d))
-    download_dataset(d)
-    batch_run(d)
-    make_plots(d)
+  args = argparser.parse_args()
+  not_done = run_steps(make_steps(), max(1, args.jobs))
+  if not_done:
+    say('not done: {}\n'.format(', '.join(sorted(not_done))))
+    sys.exit(1)
 
 if __name__ == '__main__':
   main()
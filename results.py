@@ -0,0 +1,91 @@
+# The results of batch_run.py for one dataset, in one SQLite file, which
+# make_plots.py reads. Rows are added as cells finish:
+#   cells(prefix, key): the cells done, such as amortized-7 or naive, with the
+#     key of their inputs (see batch_run.py); a cell is redone if its key
+#     changes
+#   series(prefix, kind, x, y): the points of the series |kind| (steps-freq,
+#     steps, nodes) of a cell
+#   summary(prefix, algorithm, history, key, value): one per key of the
+#     summary of a cell, such as steps-avg; naive has a row for every history
+# Each cell is added in one transaction, so an interrupted sweep leaves only
+# whole cells behind.
+
+from pathlib import Path
+
+import sqlite3
+
+schema_version = 2
+schema = '''
+  CREATE TABLE cells
+    ( prefix TEXT PRIMARY KEY, key TEXT );
+  CREATE TABLE series
+    ( prefix TEXT, kind TEXT, x INTEGER, y NUMERIC );
+  CREATE INDEX series_prefix ON series (prefix, kind);
+  CREATE TABLE summary
+    ( prefix TEXT, algorithm TEXT, history INTEGER, key TEXT, value NUMERIC );
+  CREATE INDEX summary_prefix ON summary (prefix);
+'''
+
+class ResultStore:
+  file_name = 'results.sqlite'
+
+  # Results in an older schema are dropped.
+  def __init__(self, outdir):
+    self.db = sqlite3.connect(str(Path(outdir, self.file_name)))
+    if self.db.execute('PRAGMA user_version').fetchone()[0] != schema_version:
+      for table in ('cells', 'series', 'summary'):
+        self.db.execute('DROP TABLE IF EXISTS {}'.format(table))
+      self.db.executescript(schema)
+      self.db.execute('PRAGMA user_version = {}'.format(schema_version))
+      self.db.commit()
+
+  # Returns { prefix : key } for the cells done.
+  def cells(self):
+    return dict(self.db.execute('SELECT prefix, key FROM cells'))
+
+  def remove_cell(self, prefix):
+    for table in ('cells', 'series', 'summary'):
+      self.db.execute(
+        'DELETE FROM {} WHERE prefix = ?'.format(table), (prefix,))
+
+  # Replaces the results of cell |prefix|, whose |summary| holds for each of
+  # |histories|, and commits.
+  def add_cell(self, prefix, key, algorithm, histories, summary, series):
+    with self.db:
+      self.remove_cell(prefix)
+      self.db.executemany('INSERT INTO series VALUES (?, ?, ?, ?)',
+        ((prefix, kind, x, y) for kind, xys in series.items() for x, y in xys))
+      self.db.executemany('INSERT INTO summary VALUES (?, ?, ?, ?, ?)',
+        ((prefix, algorithm, h, k, v)
+          for h in histories for k, v in summary.items()))
+      self.db.execute('INSERT INTO cells VALUES (?, ?)', (prefix, key))
+
+  def close(self):
+    self.db.commit()
+    self.db.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+# Returns (series, summary): |series[prefix, kind]| and
+# |summary[algorithm, key]| are lists of (x, y) pairs, sorted by x.
+def load_results(path):
+  # The path is quoted, so that # or ? in it are not taken as part of the URI.
+  uri = Path(path).resolve().as_uri() + '?mode=ro'
+  db = sqlite3.connect(uri, uri=True)
+  try:
+    series, summary = {}, {}
+    for prefix, kind, x, y in db.execute(
+        'SELECT prefix, kind, x, y FROM series ORDER BY prefix, kind, x'):
+      series.setdefault((prefix, kind), []).append((x, y))
+    for algorithm, key, h, v in db.execute('SELECT algorithm, key, history, '
+        'value FROM summary ORDER BY algorithm, key, history'):
+      summary.setdefault((algorithm, key), []).append((h, v))
+    return series, summary
+  finally:
+    db.close()
+
+# vim:sts=2:sw=2:
@@ -0,0 +1,74 @@
+# Streaming quantiles of nonnegative numbers, in bounded memory.
+#
+# This is the sketch of Masson, Rim, Lee, "DDSketch", VLDB 2019. Positive
+# values are counted in logarithmic buckets: bucket i holds the values in
+# (gamma^(i-1), gamma^i], where gamma = (1 + a) / (1 - a) and a is the
+# relative accuracy. A quantile is reported as the middle of its bucket, so
+# if the exact quantile (the value of rank floor(q * (count - 1)) in sorted
+# order) is x, the reported value is within a * x of x. Zero, which is common
+# for some counters, has its own bucket and is reported exactly.
+#
+# The memory is one counter per nonempty bucket, which is at most
+# log(max / min) / log(gamma) + 1; for a = 0.01 and values between 1 and 10^9
+# that is about 1050. Two sketches with the same accuracy can be merged, and
+# the result is the sketch of the concatenated streams.
+
+from collections import defaultdict
+
+import math
+
+class Sketch:
+  def __init__(self, accuracy=0.01):
+    assert 0 < accuracy < 1
+    self.accuracy = accuracy
+    self.gamma = (1 + accuracy) / (1 - accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.buckets = defaultdict(int)
+    self.zeros = 0
+    self.count = 0
+    self.max = None
+    self.small = [] # bucket of small integers, memoized
+
+  def bucket(self, x):
+    return math.ceil(math.log(x) / self.log_gamma)
+
+  def add(self, x, count=1):
+    assert x >= 0
+    self.count += count
+    if self.max is None or x > self.max:
+      self.max = x
+    if x == 0:
+      self.zeros += count
+      return
+    if type(x) is int and x < 4096:
+      while len(self.small) <= x:
+        self.small.append(self.bucket(len(self.small)) if self.small else None)
+      self.buckets[self.small[x]] += count
+    else:
+      self.buckets[self.bucket(x)] += count
+
+  def merge(self, other):
+    assert self.accuracy == other.accuracy
+    for i, n in other.buckets.items():
+      self.buckets[i] += n
+    self.zeros += other.zeros
+    self.count += other.count
+    if other.max is not None and (self.max is None or other.max > self.max):
+      self.max = other.max
+
+  # The |q|-quantile, for 0 <= q <= 1; None if nothing was added.
+  def quantile(self, q):
+    assert 0 <= q <= 1
+    if self.count == 0:
+      return None
+    rank = math.floor(q * (self.count - 1))
+    if rank < self.zeros:
+      return 0
+    seen = self.zeros
+    for i in sorted(self.buckets):
+      seen += self.buckets[i]
+      if seen > rank:
+        return min(self.max, 2 * self.gamma ** i / (self.gamma + 1))
+    assert False
+
+# vim:sts=2:sw=2:
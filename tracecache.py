@@ -0,0 +1,122 @@
+# Decompress-once cache for the datasets of batch_run.py. A dataset is decoded
+# (and, optionally, its "history" operations are dropped) once, into a plain
+# file keyed by the hash of the dataset, which all runs then replay.
+#
+# Files made by pbzip2 and similar tools hold many bz2 streams, which are
+# decompressed in parallel, a few segments at a time, so that memory stays
+# bounded however large the dataset is. A file with a single stream is
+# decompressed sequentially.
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from mmap import ACCESS_READ, mmap
+from pathlib import Path
+
+import bz2
+import hashlib
+import os
+import re
+
+block_size = 1 << 20
+segment_min_size = 1 << 20 # compressed bytes per parallel task, at least
+segment_max_size = 1 << 22 # and at most, unless a stream is larger
+stream_re = re.compile(rb'BZh[1-9]1AY&SY') # stream header, then block magic
+
+def file_hash(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      h.update(block)
+  return h.hexdigest()
+
+# Splits at the stream headers of |data| into about |count| segments, or more
+# if they would be larger than segment_max_size, and returns their (start,
+# end) offsets.
+def bz2_segments(data, count):
+  starts = [m.start() for m in stream_re.finditer(data)]
+  if not starts or starts[0] != 0:
+    return [(0, len(data))]
+  target = max(segment_min_size, min(segment_max_size, len(data) // count))
+  cuts = [0]
+  for s in starts:
+    if s - cuts[-1] >= target:
+      cuts.append(s)
+  cuts.append(len(data))
+  return list(zip(cuts, cuts[1:]))
+
+# Runs in a worker, which maps the file itself, so that only offsets are sent.
+def decompress_segment(path, start, end):
+  with open(path, 'rb') as f:
+    with mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+      return bz2.decompress(data[start:end])
+
+def sequential_blocks(path):
+  open_file = bz2.open if path.endswith('.bz2') else open
+  with open_file(path, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      yield block
+
+# Yields the decompressed content of |path|, in order.
+def decoded_blocks(path, jobs):
+  if jobs == 1 or not path.endswith('.bz2') or os.path.getsize(path) == 0:
+    yield from sequential_blocks(path)
+    return
+  with open(path, 'rb') as f:
+    with mmap(f.fileno(), 0, access=ACCESS_READ) as data:
+      segments = bz2_segments(data, 4 * jobs)
+  if len(segments) == 1:
+    yield from sequential_blocks(path)
+    return
+  # Besides the segment being yielded, at most |jobs| are decompressed ahead.
+  with ProcessPoolExecutor(jobs) as pool:
+    pending = deque()
+    for start, end in segments:
+      pending.append(pool.submit(decompress_segment, path, start, end))
+      if len(pending) > jobs:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+# Drops lines that start with 'h', as batch_run.py always did without -K.
+def drop_history(blocks):
+  history_re = re.compile(rb'^h[^\n]*\n', re.M)
+  rest = b''
+  for block in blocks:
+    block = rest + block
+    i = block.rfind(b'\n') + 1
+    rest = block[i:]
+    yield history_re.sub(b'', block[:i])
+  if not rest.startswith(b'h'):
+    yield rest
+
+# Returns the path of a plain file with the operations of dataset |path|, and
+# the hash of the dataset, which is read once for both.
+def cached_trace(path, keep_history, cache_dir, jobs=1):
+  digest = file_hash(path)
+  if keep_history and not path.endswith('.bz2'):
+    return path, digest
+  name = '{}-{}.in'.format(digest, 'all' if keep_history else 'nohistory')
+  cached = Path(cache_dir, name)
+  if cached.exists():
+    return str(cached), digest
+  cached.parent.mkdir(parents=True, exist_ok=True)
+  tmp = cached.with_suffix('.tmp{}'.format(os.getpid()))
+  try:
+    blocks = decoded_blocks(path, jobs)
+    # On failure (say, a false stream header) fall back to one stream.
+    try:
+      with tmp.open('wb') as out:
+        for block in blocks if keep_history else drop_history(blocks):
+          out.write(block)
+    except (OSError, EOFError, ValueError):
+      blocks = sequential_blocks(path)
+      with tmp.open('wb') as out:
+        for block in blocks if keep_history else drop_history(blocks):
+          out.write(block)
+    tmp.replace(cached)
+  finally:
+    if tmp.exists():
+      tmp.unlink()
+  return str(cached), digest
+
+# vim:sts=2:sw=2:
@@ -1,8 +1,13 @@
+#define _POSIX_C_SOURCE 199309L // for clock_gettime
+
 #include <assert.h>
 #include <stdarg.h>
+#include <stdbool.h>
 #include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
+#include <time.h>
 #include "treebuffer.h"
 
 #define unused(x) ((void)x)
@@ -11,16 +16,18 @@
 #define MMM (t->mems += 3)
 #define MMMM (t->mems += 4)
 
+// Hot fields (the links) first; 56 bytes on LP64.
 struct Node {
   Node * parent;
-  int children; // the number of x such that (x->parent == this)
   Node * ll, * rl; // left link, right link; used for several lists
-  int depth; // distance to root
   Node * representant; // ancestor with (depth % history == 0)
+  int children; // the number of x such that (x->parent == this)
+  int depth; // distance to root
   int active_count; // number of x that are active and x->representant == this
+  int data;
   char seen; // used for garbage collection
   char active;
-  int data;
+  char pooled; // allocated by tb_new_node, in the arena of its tree
 
   // NOTE: All lists using |ll| and |rl| are doubly linked, circular, and
   // using a sentinel.
@@ -28,12 +35,63 @@ struct Node {
   // TODO: pointer to tree so that I can assert that added nodes aren't already in a tree
 };
 
+// Nodes made by tb_new_node come from slabs owned by the tree, which grow
+// geometrically up to |slab_max| nodes. Freed nodes go on a free list, linked
+// through |parent|; the slabs themselves are freed only by delete().
+#define slab_min (1 << 6)
+#define slab_max (1 << 16)
+
+typedef struct Slab {
+  struct Slab * next;
+  Node nodes[];
+} Slab;
+
+typedef struct {
+  Slab * slabs;
+  int slab_size; // of slabs->nodes
+  int slab_used; // nodes of slabs->nodes handed out so far
+  Node * free_nodes;
+} Arena;
+
+// Histogram of nonnegative values: exact below |exact_limit|; above, values
+// with the same leading |sub_bits|+1 bits share a bucket.
+#define exact_limit (1 << 12)
+#define sub_bits 4
+#define log_buckets ((64 - 12) << sub_bits)
+
+typedef struct {
+  long long count, sum, max;
+  double sum2;
+  long long exact[exact_limit];
+  long long log[log_buckets];
+} Histogram;
+
+enum { stat_add_child, stat_deactivate, stat_history, stat_delete, stat_gc,
+  stat_nodes, stat_count };
+const char * stat_names[] =
+  { "add_child", "deactivate", "history", "delete", "gc", "nodes" };
+  // The first |timed_count| are also timed, if |timing| is on.
+#define timed_count (stat_delete + 1)
+
+typedef struct {
+  FILE * summary_file;
+  long long peak;
+  Histogram h[stat_count];
+  bool timing;
+  long long started; // nanoseconds, when the current operation started
+  Histogram ns[timed_count];
+} Statistics;
+
 struct Tree {
   int history;
   enum algo algo;
   Node * active; // list of active nodes
   Node * to_delete;
   FILE * statistics_file;
+  Statistics * aggregate;
+  long long live; // number of nodes not yet freed; only for statistics
+  Arena arena;
+  long long external; // number of nodes in the tree made by tb_make_node
   int node_count; // only maintained by tb_amortized
   int last_gc_node_count; // only maintained by tb_amortized
   int mems;
@@ -43,12 +101,77 @@ void tb_start_collecting_statistics(Tree * t, FILE * statistics_file) {
   assert (t);
   assert (statistics_file);
   assert (!t->statistics_file);
+  assert (!t->aggregate);
   t->statistics_file = statistics_file;
 }
 
+void tb_start_aggregating_statistics(Tree * t, FILE * summary_file) {
+  assert (t);
+  assert (!t->statistics_file);
+  assert (!t->aggregate);
+  t->aggregate = calloc(1, sizeof(Statistics));
+  assert (t->aggregate);
+  t->aggregate->summary_file = summary_file;
+  t->aggregate->peak = t->live;
+}
+
+void tb_start_timing(Tree * t) {
+  assert (t);
+  assert (t->aggregate);
+  t->aggregate->timing = true;
+}
+
 void tb_stop_collecting_statistics(Tree * t) {
   assert (t);
   t->statistics_file = 0;
+  free(t->aggregate);
+  t->aggregate = 0;
+}
+
+void add_to_histogram(Histogram * h, long long x) {
+  assert (x >= 0);
+  ++h->count;
+  h->sum += x;
+  h->sum2 += (double) x * x;
+  if (x > h->max) h->max = x;
+  if (x < exact_limit) {
+    ++h->exact[x];
+  } else {
+    int e = 12;
+    while (x >> (e + 1)) ++e;
+    ++h->log[((e - 12) << sub_bits) | ((x >> (e - sub_bits)) & ((1 << sub_bits) - 1))];
+  }
+}
+
+void print_histogram(FILE * f, const char * name, const Histogram * h) {
+  fprintf(f, "%s %lld %lld %.17g %lld", name, h->count, h->sum, h->sum2, h->max);
+  for (int i = 0; i < exact_limit; ++i) {
+    if (h->exact[i]) fprintf(f, " %d:%lld", i, h->exact[i]);
+  }
+  for (int i = 0; i < log_buckets; ++i) {
+    if (!h->log[i]) continue;
+    int e = (i >> sub_bits) + 12;
+    long long low = (long long) ((1 << sub_bits) | (i & ((1 << sub_bits) - 1)))
+      << (e - sub_bits);
+    fprintf(f, " %lld:%lld", low, h->log[i]);
+  }
+  fprintf(f, "\n");
+}
+
+void tb_print_statistics(const Tree * t, FILE * f) {
+  assert (t);
+  assert (f);
+  assert (t->aggregate);
+  fprintf(f, "live %lld peak %lld\n", t->live, t->aggregate->peak);
+  for (int i = 0; i < stat_count; ++i) {
+    print_histogram(f, stat_names[i], &t->aggregate->h[i]);
+  }
+  for (int i = 0; t->aggregate->timing && i < timed_count; ++i) {
+    char name[32];
+    sprintf(name, "%s_ns", stat_names[i]);
+    print_histogram(f, name, &t->aggregate->ns[i]);
+  }
+  fflush(f);
 }
 
 void print_statistic(Tree * t, const char * format, ...) {
@@ -59,8 +182,41 @@ void print_statistic(Tree * t, const char * format, ...) {
   va_end(ap);
 }
 
-Node * tb_make_node(int data) {
-  Node * r = malloc(sizeof(Node));
+void note_nodes(Tree * t, int delta) {
+  t->live += delta;
+  if (t->aggregate) {
+    if (t->live > t->aggregate->peak) t->aggregate->peak = t->live;
+  } else {
+    print_statistic(t, delta > 0 ? "S +1\n" : "S -1\n");
+  }
+}
+
+long long now_ns() {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec * 1000000000LL + ts.tv_nsec;
+}
+
+// Called at the start of each operation that is timed.
+void start_operation(Tree * t) {
+  if (t->aggregate && t->aggregate->timing) t->aggregate->started = now_ns();
+}
+
+// Called at the end of each operation; |code| is for the verbose log.
+void note_operation(Tree * t, int type, const char * code) {
+  if (t->aggregate && t->aggregate->timing) {
+    long long ns = now_ns() - t->aggregate->started;
+    add_to_histogram(&t->aggregate->ns[type], ns < 0 ? 0 : ns);
+  }
+  if (t->aggregate) {
+    add_to_histogram(&t->aggregate->h[type], t->mems);
+    add_to_histogram(&t->aggregate->h[stat_nodes], t->live);
+  } else {
+    print_statistic(t, "%s %d\n", code, t->mems);
+  }
+}
+
+void init_node(Node * r, int data, char pooled) {
   r->parent = 0;
   r->children = 0;
   r->ll = r->rl = r;
@@ -69,36 +225,106 @@ Node * tb_make_node(int data) {
   r->active_count = 0;
   r->seen = 0;
   r->active = 1;
+  r->pooled = pooled;
   r->data = data;
+}
+
+Node * tb_make_node(int data) {
+  Node * r = malloc(sizeof(Node));
+  assert (r);
+  init_node(r, data, 0);
   return r;
 }
 
+Node * tb_new_node(Tree * t, int data) {
+  assert (t);
+  Arena * a = &t->arena;
+  Node * r = a->free_nodes;
+  if (r) {
+    a->free_nodes = r->parent;
+  } else {
+    if (!a->slabs || a->slab_used == a->slab_size) {
+      int size = !a->slabs ? slab_min
+        : a->slab_size < slab_max ? 2 * a->slab_size : slab_max;
+      Slab * s = malloc(sizeof(Slab) + (size_t) size * sizeof(Node));
+      assert (s);
+      s->next = a->slabs;
+      a->slabs = s;
+      a->slab_size = size;
+      a->slab_used = 0;
+    }
+    r = &a->slabs->nodes[a->slab_used++];
+  }
+  init_node(r, data, 1);
+  return r;
+}
+
+// Gives |x|, which was in |t|, back to where it was allocated.
+void free_node(Tree * t, Node * x) {
+  if (x->pooled) {
+    x->parent = t->arena.free_nodes;
+    t->arena.free_nodes = x;
+  } else {
+    free(x);
+    --t->external;
+  }
+}
+
+void free_arena(Arena * a) {
+  for (Slab * s = a->slabs, * n; s; s = n) {
+    n = s->next;
+    free(s);
+  }
+}
+
 int tb_get_data(Node * x) {
   return x->data;
 }
 
-Tree * tb_initialize(int history, enum algo algo, Node * root) {
-  assert (root);
+// A tree without root, which the caller must set with set_root.
+Tree * make_tree(int history, enum algo algo) {
   assert (history > 0);
   Tree * t = malloc(sizeof(Tree));
+  assert (t);
   t->history = history;
   t->algo = algo;
   t->active = malloc(sizeof(Node));
-  t->active->ll = t->active->rl = root;
-  root->ll = root->rl = t->active;
-  root->depth = 0;
-  root->representant = root;
-  root->active_count = 1;
-  assert (root->active);
   t->to_delete = malloc(sizeof(Node));
   t->to_delete->ll = t->to_delete->rl = t->to_delete;
   t->statistics_file = 0;
+  t->aggregate = 0;
+  t->live = 1;
+  t->arena = (Arena) { 0, 0, 0, 0 };
   t->node_count = 1;
   t->last_gc_node_count = 1;
   t->mems = 0;
   return t;
 }
 
+void set_root(Tree * t, Node * root) {
+  assert (root);
+  assert (root->active);
+  t->active->ll = t->active->rl = root;
+  root->ll = root->rl = t->active;
+  root->depth = 0;
+  root->representant = root;
+  root->active_count = 1;
+  t->external = !root->pooled;
+}
+
+Tree * tb_initialize(int history, enum algo algo, Node * root) {
+  assert (root);
+  Tree * t = make_tree(history, algo);
+  set_root(t, root);
+  return t;
+}
+
+Tree * tb_initialize_data(int history, enum algo algo, int root_data) {
+  Tree * t = make_tree(history, algo);
+  set_root(t, tb_new_node(t, root_data));
+  return t;
+}
+
 void cut_parent(Tree * t, Node * y) {
   Node * x = (M, y->parent);
   if (x && (M, --x->children == 0) && !(M, x->active)) {
@@ -118,13 +344,23 @@ void delete_one(Tree * t) {
   x->ll->rl = x->rl, MMM; x->rl->ll = x->ll, MMM;
   x->ll = x->rl = x, MM;
   cut_parent(t, x);
-  free(x), M;
-  print_statistic(t, "S -1\n");
+  free_node(t, x), M;
+  note_nodes(t, -1);
 }
 
+// Without statistics, and if all nodes came from the arena, there is no need
+// to visit the nodes: the arena is freed in one go.
 void delete(Tree * t) {
   if (!t) return;
   assert (t->mems == 0);
+  if (!t->statistics_file && !t->aggregate && t->external == 0) {
+    free_arena(&t->arena);
+    free(t->active);
+    free(t->to_delete);
+    free(t);
+    return;
+  }
+  start_operation(t);
 
   // Move |active| into |to_delete|.
   { Node * L = (MM, t->active->ll);
@@ -139,8 +375,13 @@ void delete(Tree * t) {
   // Cleanup.
   t->algo = tb_real_time, M;
   while ((MMM, t->to_delete->rl != t->to_delete)) delete_one(t);
-  print_statistic(t, "TF %d\n", t->mems);
+  note_operation(t, stat_delete, "TF");
   t->mems = 0;
+  if (t->aggregate && t->aggregate->summary_file) {
+    tb_print_statistics(t, t->aggregate->summary_file);
+  }
+  free_arena(&t->arena);
+  free(t->aggregate);
   free(t->active);
   free(t->to_delete);
   free(t);
@@ -165,9 +406,9 @@ void gc_node(Tree * t, Node * x) {
   assert (!x->active);
   assert (x->children == 0);
   gc_parent(t, x);
-  free(x);
+  free_node(t, x);
   if (t->algo == tb_amortized) --t->node_count, M;
-  print_statistic(t, "S -1\n");
+  note_nodes(t, -1);
 }
 
 void gc_parent(Tree * t, Node * y) {
@@ -183,6 +424,7 @@ void gc_parent(Tree * t, Node * y) {
 void gc(Tree * t) {
   assert (t);
   assert (t->algo == tb_gc || t->algo == tb_amortized);
+  int mems_before = t->mems;
 
   for (Node * n = (MM, t->active->rl); (M, n != t->active); (M, n = n->rl)) {
     n->seen = 1, M;
@@ -244,13 +486,18 @@ void gc(Tree * t) {
   if (t->algo == tb_amortized) {
     t->last_gc_node_count = t->node_count, MM;
   }
+  if (t->aggregate) {
+    add_to_histogram(&t->aggregate->h[stat_gc], t->mems - mems_before);
+  }
 }
 
 void tb_add_child(Tree * t, Node * parent, Node * child) {
   assert (t);
   assert (t->mems == 0);
+  start_operation(t);
   assert (parent);
   assert (child);
+  if (!child->pooled) ++t->external;
   child->parent = parent, M;
   ++parent->children, M;
   child->ll = t->active, MM; child->rl = t->active->rl, MMM;
@@ -264,14 +511,15 @@ void tb_add_child(Tree * t, Node * parent, Node * child) {
       (MM, child->depth % t->history == 0)? child : (M, parent->representant); M;
     ++child->representant->active_count, MM;
   }
-  print_statistic(t, "S +1\n");
-  print_statistic(t, "TA %d\n", t->mems);
+  note_nodes(t, +1);
+  note_operation(t, stat_add_child, "TA");
   t->mems = 0;
 }
 
 void tb_deactivate(Tree * t, Node * n) {
   assert (t);
   assert (t->mems == 0);
+  start_operation(t);
   assert (n);
   assert (n->active);
   n->active = 0;
@@ -290,7 +538,7 @@ void tb_deactivate(Tree * t, Node * n) {
       cut_parent(t, n->representant);
     }
   }
-  print_statistic(t, "TD %d\n", t->mems);
+  note_operation(t, stat_deactivate, "TD");
   t->mems = 0;
 }
 
@@ -301,6 +549,7 @@ void tb_expand(Tree * t, Node * parent, Node * children[]) {
 
 void tb_history(Tree * t, Node * node, Node * ancestors[]) {
   assert (t->mems == 0);
+  start_operation(t);
   assert (node->active);
   int h = (M, t->history);
   while (node && h--) {
@@ -308,10 +557,279 @@ void tb_history(Tree * t, Node * node, Node * ancestors[]) {
     node = node->parent, M;
   }
   *ancestors = 0, M;
-  print_statistic(t, "TH %d\n", t->mems);
+  note_operation(t, stat_history, "TH");
   t->mems = 0;
 }
 
+void tb_expand_data(
+    Tree * t, Node * parent, int n, const int data[], Node * children[]) {
+  assert (n >= 0);
+  for (int i = 0; i < n; ++i) children[i] = tb_new_node(t, data[i]);
+  children[n] = 0;
+  tb_expand(t, parent, children);
+}
+
+void tb_history_data(
+    Tree * t, int n, Node * nodes[], int lengths[], int data[]) {
+  assert (t);
+  Node ** ancestors = malloc((t->history + 1) * sizeof(Node *));
+  assert (ancestors);
+  for (int i = 0; i < n; ++i) {
+    tb_history(t, nodes[i], ancestors);
+    int * d = data + (size_t) i * t->history;
+    for (lengths[i] = 0; ancestors[lengths[i]]; ++lengths[i]) {
+      d[lengths[i]] = ancestors[lengths[i]]->data;
+    }
+  }
+  free(ancestors);
+}
+
+long long tb_live_nodes(const Tree * t) {
+  assert (t);
+  return t->live;
+}
+
+// For tb_history_forest and tb_checkpoint: the histories of some active nodes
+// as a forest of |m| nodes. Forest node i is |node[i]|, and its index is in
+// the hash table |keys|/|values|, which uses linear probing.
+typedef struct {
+  const Node ** keys;
+  int * values;
+  size_t mask;
+  int m;
+  Node ** node;
+  int * reach;
+  Node ** above;
+} Forest;
+
+size_t hash_node(const Node * x) {
+  return (size_t) (((uintptr_t) x / sizeof(Node)) * 2654435761u);
+}
+
+// Returns where |x| is in the hash table of |f|, or would go.
+size_t find_node(const Forest * f, const Node * x) {
+  size_t i = hash_node(x) & f->mask;
+  while (f->keys[i] && f->keys[i] != x) i = (i + 1) & f->mask;
+  return i;
+}
+
+// Returns the forest index of |x|, or -1.
+int forest_index(const Forest * f, const Node * x) {
+  size_t i = find_node(f, x);
+  return f->keys[i] ? f->values[i] : -1;
+}
+
+void free_forest(Forest * f) {
+  free(f->keys);
+  free(f->values);
+  free(f->node);
+  free(f->reach);
+  free(f->above);
+}
+
+// Forest node i was reached by a walk that wanted |reach[i]| nodes from it
+// up; if the walk stopped there for that reason, the next node up is in
+// |above[i]|. A later walk that wants more goes up the forest, and goes on
+// in the tree only from there, so each node of the tree is read once.
+void build_forest(Tree * t, int n, Node * nodes[], int index[],
+    int parent[], int data[], Forest * f) {
+  long long most = (long long) n * t->history;
+  if (most > t->live) most = t->live;
+  size_t size = 2;
+  while (size < 2 * (size_t) most) size *= 2;
+  size_t room = most ? most : 1;
+  *f = (Forest) { calloc(size, sizeof(Node *)), malloc(size * sizeof(int)),
+    size - 1, 0, malloc(room * sizeof(Node *)), malloc(room * sizeof(int)),
+    malloc(room * sizeof(Node *)) };
+  assert (f->keys && f->values && f->node && f->reach && f->above);
+  int m = 0;
+  for (int j = 0; j < n; ++j) {
+    assert (nodes[j]->active);
+    Node * x = nodes[j];
+    int * link = &index[j];
+    int r = (M, t->history);
+    while (x) {
+      size_t slot = find_node(f, x);
+      if (!f->keys[slot]) {
+        f->keys[slot] = x;
+        f->values[slot] = *link = m;
+        f->node[m] = x;
+        data[m] = x->data, M;
+        parent[m] = -1;
+        f->reach[m] = r;
+        f->above[m] = 0;
+        link = &parent[m++];
+        x = x->parent, M;
+        if (--r == 0) {
+          f->above[m - 1] = x;
+          break;
+        }
+        continue;
+      }
+      int i = *link = f->values[slot];
+      x = 0;
+      while (f->reach[i] < r) {
+        f->reach[i] = r--;
+        if (parent[i] != -1) {
+          i = parent[i];
+        } else {
+          x = f->above[i];
+          f->above[i] = 0;
+          link = &parent[i];
+          break;
+        }
+      }
+    }
+  }
+  f->m = m;
+}
+
+int tb_history_forest(Tree * t, int n, Node * nodes[], int index[],
+    int parent[], int data[]) {
+  assert (t);
+  assert (t->mems == 0);
+  assert (n >= 0);
+  start_operation(t);
+  Forest f;
+  build_forest(t, n, nodes, index, parent, data, &f);
+  free_forest(&f);
+  note_operation(t, stat_history, "TH");
+  t->mems = 0;
+  return f.m;
+}
+
+int tb_history_length(const Tree * t) {
+  assert (t);
+  return t->history;
+}
+
+// A checkpoint is |checkpoint_magic|, then the ints history, algo, m (number
+// of nodes) and n (number of active nodes), then arrays of m ints: data,
+// parent, depth, representant, active_count. Node i is the i-th of the
+// active nodes given to tb_checkpoint if i < n; parent and representant are
+// node numbers, or -1.
+const char checkpoint_magic[8] = "tbckpt1\n";
+enum { checkpoint_arrays = 5 };
+
+int tb_checkpoint(Tree * t, FILE * file, int n, Node * nodes[]) {
+  assert (t);
+  assert (t->mems == 0);
+  assert (n >= 0);
+  { int a = 0;
+    for (Node * x = tb_active(t); x; x = tb_next_active(t, x)) ++a;
+    assert (a == n);
+  }
+  long long most = (long long) n * t->history;
+  size_t room = most < t->live ? most + 1 : t->live + 1;
+  int * index = malloc((n ? n : 1) * sizeof(int));
+  int * parent = malloc(room * sizeof(int));
+  int * data = malloc(room * sizeof(int));
+  int * number = malloc(room * sizeof(int));
+  int * fields = malloc(checkpoint_arrays * room * sizeof(int));
+  assert (index && parent && data && number && fields);
+  Forest f;
+  build_forest(t, n, nodes, index, parent, data, &f);
+  t->mems = 0;
+  int m = f.m;
+  // The active nodes come first, in the order given.
+  for (int i = 0; i < m; ++i) number[i] = -1;
+  for (int j = 0; j < n; ++j) {
+    assert (number[index[j]] == -1); // no node twice
+    number[index[j]] = j;
+  }
+  int next = n;
+  for (int i = 0; i < m; ++i) if (number[i] == -1) number[i] = next++;
+  int * out[checkpoint_arrays];
+  for (int k = 0; k < checkpoint_arrays; ++k) out[k] = fields + k * room;
+  for (int i = 0; i < m; ++i) {
+    Node * x = f.node[i];
+    int p = parent[i];
+    // A walk that stopped below a node that another walk reached.
+    if (p == -1 && f.above[i]) p = forest_index(&f, f.above[i]);
+    int r = x->representant ? forest_index(&f, x->representant) : -1;
+    int k = number[i];
+    out[0][k] = data[i];
+    out[1][k] = p == -1 ? -1 : number[p];
+    out[2][k] = x->depth;
+    out[3][k] = r == -1 ? -1 : number[r];
+    out[4][k] = x->active_count;
+  }
+  int header[4] = { t->history, t->algo, m, n };
+  bool ok = fwrite(checkpoint_magic, 1, sizeof(checkpoint_magic), file)
+      == sizeof(checkpoint_magic)
+    && fwrite(header, sizeof(int), 4, file) == 4;
+  for (int k = 0; ok && k < checkpoint_arrays; ++k) {
+    ok = fwrite(out[k], sizeof(int), m, file) == (size_t) m;
+  }
+  free_forest(&f);
+  free(fields);
+  free(number);
+  free(data);
+  free(parent);
+  free(index);
+  return ok && !fflush(file) ? 0 : -1;
+}
+
+Tree * tb_restore(FILE * file, int n, Node * nodes[]) {
+  char magic[sizeof(checkpoint_magic)];
+  int header[4];
+  if (fread(magic, 1, sizeof(magic), file) != sizeof(magic)
+      || memcmp(magic, checkpoint_magic, sizeof(magic))
+      || fread(header, sizeof(int), 4, file) != 4) {
+    return 0;
+  }
+  int history = header[0], algo = header[1], m = header[2];
+  if (history <= 0 || algo < tb_naive || algo > tb_real_time
+      || header[3] != n || m < n || n < 0) {
+    return 0;
+  }
+  int * fields = malloc(checkpoint_arrays * (size_t) (m ? m : 1) * sizeof(int));
+  assert (fields);
+  int * in[checkpoint_arrays];
+  bool ok = true;
+  for (int k = 0; k < checkpoint_arrays; ++k) {
+    in[k] = fields + (size_t) k * m;
+    ok = ok && fread(in[k], sizeof(int), m, file) == (size_t) m;
+  }
+  for (int i = 0; ok && i < m; ++i) {
+    ok = -1 <= in[1][i] && in[1][i] < m && -1 <= in[3][i] && in[3][i] < m;
+  }
+  if (!ok) {
+    free(fields);
+    return 0;
+  }
+  Tree * t = make_tree(history, algo);
+  t->external = 0;
+  Node ** made = malloc((m ? m : 1) * sizeof(Node *));
+  assert (made);
+  for (int i = 0; i < m; ++i) made[i] = tb_new_node(t, in[0][i]);
+  for (int i = 0; i < m; ++i) {
+    Node * x = made[i];
+    x->parent = in[1][i] == -1 ? 0 : made[in[1][i]];
+    if (x->parent) ++x->parent->children;
+    x->depth = in[2][i];
+    x->representant = in[3][i] == -1 ? 0 : made[in[3][i]];
+    x->active_count = in[4][i];
+    x->active = i < n;
+  }
+  // The active list, in order; the other nodes all have children, so none
+  // is waiting in |to_delete|.
+  Node * last = t->active;
+  for (int i = 0; i < n; ++i) {
+    made[i]->ll = last;
+    last->rl = made[i];
+    last = made[i];
+    nodes[i] = made[i];
+  }
+  last->rl = t->active;
+  t->active->ll = last;
+  t->live = m;
+  t->node_count = t->last_gc_node_count = m;
+  free(made);
+  free(fields);
+  return t;
+}
+
 Node * tb_active(const Tree * t) {
   assert (t);
   if (t->active->rl == t->active) return 0;
@@ -9,8 +9,14 @@ typedef struct Node Node;
 typedef struct Tree Tree;
 
 Node * tb_make_node(int data);
+Node * tb_new_node(Tree * tree, int data);
+  /* like tb_make_node, but from the node arena of |tree|, to which the node
+     may only be added; cheaper, and freed with the tree in any case */
 int tb_get_data(Node * node);
 Tree * tb_initialize(int history, enum algo algo, Node * root);
+Tree * tb_initialize_data(int history, enum algo algo, int root_data);
+  /* the root comes from the arena too; it is tb_active() until it is
+     deactivated */
 void delete(Tree * tree);
 
 /* NOTE: The client must allocate/deallocate the 0-terminated arrays |children|
@@ -24,12 +30,65 @@ void tb_history(Tree * tree, Node * node, Node * ancestors[]);
   /* history of |node| is put in |ancestors|, which is 0-terminated;
      |node| must be active */
 
+/* Bulk versions, which save a call per node for bindings. */
+void tb_expand_data(Tree * tree, Node * parent, int n, const int data[],
+    Node * children[]);
+  /* makes |n| new nodes holding |data|, puts them in |children|, which must
+     have room for n+1 pointers and is 0-terminated, then expands |parent| */
+void tb_history_data(Tree * tree, int n, Node * nodes[], int lengths[],
+    int data[]);
+  /* for each of the |n| active |nodes|, the data of its history goes in
+     |data|, at offset i*history, and its length in |lengths[i]| */
+
+int tb_history_forest(Tree * tree, int n, Node * nodes[], int index[],
+    int parent[], int data[]);
+  /* the histories of the |n| active |nodes| as one forest, in which each
+     ancestor appears, and is visited, once: forest node i holds |data[i]|
+     and has parent |parent[i]|, or -1; the history of nodes[j] is the path
+     up from forest node |index[j]|, cut at |history| nodes. Returns the size
+     of the forest; |parent| and |data| must have room for
+     min(n * history, tb_live_nodes(tree)) entries. Counts as one history
+     operation in the statistics. */
+long long tb_live_nodes(const Tree * tree);
+  /* the number of nodes made and not yet freed */
+int tb_history_length(const Tree * tree);
+
+/* Checkpoints keep only what later operations can see: the active nodes and
+their ancestors within |history|, with the bookkeeping of the algorithm. They
+are in the native byte order. */
+int tb_checkpoint(Tree * tree, FILE * file, int n, Node * nodes[]);
+  /* writes |tree| to |file|; |nodes| are its |n| active nodes, in any order;
+     returns 0, or -1 if writing failed */
+Tree * tb_restore(FILE * file, int n, Node * nodes[]);
+  /* reads a tree written by tb_checkpoint with |n| active nodes, which go in
+     |nodes| in the order they were given then; returns 0 if |file| holds no
+     such tree. Statistics are not restored. Takes time linear in the size of
+     the checkpoint. */
+
 Node * tb_active(const Tree * tree);
 Node * tb_next_active(const Tree * tree, const Node * node);
   // Intended use:
   //   for (Node * n = tb_active(t); n; n = tb_next_active(t, n)) { ... }
 
 void tb_start_collecting_statistics(Tree * tree, FILE * statistics_file);
+  /* one line per operation: "TA n", "TD n", "TH n", "TF n" for add_child,
+     deactivate, history, delete, with n the number of memory references;
+     before that, "S +1" or "S -1" for each node made or freed */
+void tb_start_aggregating_statistics(Tree * tree, FILE * summary_file);
+  /* keeps histograms in memory instead, and prints a summary to
+     |summary_file| (if not 0) at delete(), or on tb_print_statistics */
+void tb_start_timing(Tree * tree);
+  /* when aggregating statistics, also measure the wall-clock time of each
+     operation; the summary then has histograms add_child_ns, deactivate_ns,
+     history_ns and delete_ns, in nanoseconds */
+void tb_print_statistics(const Tree * tree, FILE * summary_file);
+  /* The summary has a line "live L peak P" with the current and maximum
+     number of nodes, then one line per histogram:
+       NAME COUNT SUM SUM_OF_SQUARES MAX VALUE:COUNT ...
+     for NAME in add_child, deactivate, history, delete (memory references
+     per operation), gc (memory references per collection), and nodes (nodes
+     after each operation). Values under 4096 are exact; larger values are
+     rounded down to their 5 leading bits. */
 void tb_stop_collecting_statistics(Tree * tree);
 
 #endif
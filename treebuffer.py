@@ -0,0 +1,251 @@
+# Python binding for treebuffer.h, over the shared library libtreebuffer.so
+# (say `make`). The library is looked up next to this file, unless the
+# environment variable TREEBUFFER_LIB names it. The binding uses ctypes, which
+# releases the GIL for the duration of each call into the library.
+#
+#   root = Node(-1)
+#   with Tree(10, 'gc', root) as t:
+#     a, b = t.expand_data(root, [1, 2])
+#     t.history(a)  # [1, -1]
+#
+# As in C, nodes belong to the tree once added, and may be freed by it after
+# they are deactivated.
+
+from ctypes import CDLL, POINTER, c_char_p, c_int, c_longlong, c_void_p
+from ctypes.util import find_library
+from pathlib import Path
+from util import algorithms
+
+import os
+import struct
+
+library_path = os.environ.get('TREEBUFFER_LIB',
+  str(Path(__file__).resolve().parent / 'libtreebuffer.so'))
+try:
+  lib = CDLL(library_path)
+except OSError as e:
+  raise ImportError(
+    'cannot load {} (say make): {}'.format(library_path, e)) from None
+libc = CDLL(find_library('c'))
+
+def declare(f, restype, *argtypes):
+  f.restype = restype
+  f.argtypes = argtypes
+
+IntArray = POINTER(c_int)
+NodeArray = POINTER(c_void_p)
+declare(lib.tb_make_node, c_void_p, c_int)
+declare(lib.tb_new_node, c_void_p, c_void_p, c_int)
+declare(lib.tb_get_data, c_int, c_void_p)
+declare(lib.tb_initialize, c_void_p, c_int, c_int, c_void_p)
+declare(lib.delete, None, c_void_p)
+declare(lib.tb_add_child, None, c_void_p, c_void_p, c_void_p)
+declare(lib.tb_deactivate, None, c_void_p, c_void_p)
+declare(lib.tb_expand, None, c_void_p, c_void_p, NodeArray)
+declare(lib.tb_history, None, c_void_p, c_void_p, NodeArray)
+declare(lib.tb_expand_data, None, c_void_p, c_void_p, c_int, IntArray, NodeArray)
+declare(lib.tb_history_data, None, c_void_p, c_int, NodeArray, IntArray, IntArray)
+declare(lib.tb_history_forest, c_int, c_void_p, c_int, NodeArray, IntArray, IntArray, IntArray)
+declare(lib.tb_live_nodes, c_longlong, c_void_p)
+declare(lib.tb_history_length, c_int, c_void_p)
+declare(lib.tb_checkpoint, c_int, c_void_p, c_void_p, c_int, NodeArray)
+declare(lib.tb_restore, c_void_p, c_void_p, c_int, NodeArray)
+declare(lib.tb_active, c_void_p, c_void_p)
+declare(lib.tb_next_active, c_void_p, c_void_p, c_void_p)
+declare(lib.tb_start_collecting_statistics, None, c_void_p, c_void_p)
+declare(lib.tb_start_aggregating_statistics, None, c_void_p, c_void_p)
+declare(lib.tb_start_timing, None, c_void_p)
+declare(lib.tb_print_statistics, None, c_void_p, c_void_p)
+declare(lib.tb_stop_collecting_statistics, None, c_void_p)
+declare(libc.fopen, c_void_p, c_char_p, c_char_p)
+declare(libc.fclose, c_int, c_void_p)
+
+class Node:
+  __slots__ = ('_as_parameter_',)
+
+  def __init__(self, data=None, pointer=None):
+    if pointer is None:
+      pointer = lib.tb_make_node(data)
+    self._as_parameter_ = pointer
+
+  @property
+  def data(self):
+    return lib.tb_get_data(self)
+
+  def __eq__(self, other):
+    return isinstance(other, Node) and \
+      self._as_parameter_ == other._as_parameter_
+
+  def __hash__(self):
+    return hash(self._as_parameter_)
+
+  def __repr__(self):
+    return 'Node({})'.format(self.data)
+
+# The start of the files written by tb_checkpoint: magic, history, algorithm,
+# number of nodes, number of active nodes.
+checkpoint_header = struct.Struct('=8s4i')
+
+class Tree:
+  def __init__(self, history, algorithm, root):
+    if history <= 0:
+      raise ValueError('history must be positive')
+    self.setup(history, algorithm,
+      lib.tb_initialize(history, algorithms.index(algorithm), root))
+
+  def setup(self, history, algorithm, pointer):
+    self.history_length = history
+    self.algorithm = algorithm
+    self._as_parameter_ = pointer
+    self.statistics_file = None
+    self.ancestors = (c_void_p * (history + 1))()
+
+  # Saves the tree to |path|, for restore. |nodes| must be all the active
+  # nodes; restore gives them back in the same order.
+  def checkpoint(self, path, nodes):
+    f = libc.fopen(os.fsencode(path), b'wb')
+    if not f:
+      raise OSError('cannot write to {}'.format(path))
+    n = len(nodes)
+    pointers = (c_void_p * max(1, n))(*(x._as_parameter_ for x in nodes))
+    failed = lib.tb_checkpoint(self, f, n, pointers)
+    if libc.fclose(f) or failed:
+      raise OSError('cannot write to {}'.format(path))
+
+  # Returns (tree, nodes) as saved by checkpoint.
+  @classmethod
+  def restore(cls, path):
+    with open(path, 'rb') as f:
+      header = f.read(checkpoint_header.size)
+    if len(header) < checkpoint_header.size:
+      raise ValueError('{} is not a checkpoint'.format(path))
+    _, history, algorithm, _, n = checkpoint_header.unpack(header)
+    f = libc.fopen(os.fsencode(path), b'rb')
+    if not f:
+      raise OSError('cannot read {}'.format(path))
+    nodes = (c_void_p * max(1, n))()
+    pointer = lib.tb_restore(f, n, nodes)
+    libc.fclose(f)
+    if not pointer:
+      raise ValueError('{} is not a checkpoint'.format(path))
+    tree = cls.__new__(cls)
+    tree.setup(history, algorithms[algorithm], pointer)
+    return tree, [Node(pointer=nodes[i]) for i in range(n)]
+
+  # A node from the arena of this tree, to which it may only be added.
+  def new_node(self, data):
+    return Node(pointer=lib.tb_new_node(self, data))
+
+  def add_child(self, parent, child):
+    lib.tb_add_child(self, parent, child)
+
+  def deactivate(self, node):
+    lib.tb_deactivate(self, node)
+
+  def expand(self, parent, children):
+    array = (c_void_p * (len(children) + 1))(
+      *(c._as_parameter_ for c in children))
+    lib.tb_expand(self, parent, array)
+
+  def history(self, node):
+    lib.tb_history(self, node, self.ancestors)
+    result = []
+    for p in self.ancestors:
+      if not p:
+        break
+      result.append(lib.tb_get_data(p))
+    return result
+
+  # Makes one child per element of |data|, expands |parent| with them, and
+  # returns the children.
+  def expand_data(self, parent, data):
+    n = len(data)
+    children = (c_void_p * (n + 1))()
+    lib.tb_expand_data(self, parent, n, (c_int * n)(*data), children)
+    return [Node(pointer=children[i]) for i in range(n)]
+
+  # Returns the history of each of |nodes|, as lists of data.
+  def histories(self, nodes):
+    n = len(nodes)
+    lengths = (c_int * n)()
+    data = (c_int * (n * self.history_length))()
+    pointers = (c_void_p * n)(*(x._as_parameter_ for x in nodes))
+    lib.tb_history_data(self, n, pointers, lengths, data)
+    h = self.history_length
+    return [data[i * h : i * h + lengths[i]] for i in range(n)]
+
+  # The histories of |nodes| (by default, of all active nodes) as one forest,
+  # in NumPy arrays (index, parent, data): forest node i holds data[i] and has
+  # parent parent[i], or -1; the history of nodes[j] is the path up from
+  # index[j], cut at history_length nodes. Shared ancestors appear once.
+  def history_forest(self, nodes=None):
+    import numpy
+    if nodes is None:
+      nodes = list(self.active())
+    n = len(nodes)
+    size = max(1, min(n * self.history_length, lib.tb_live_nodes(self)))
+    index = numpy.empty(max(1, n), numpy.intc)
+    parent = numpy.empty(size, numpy.intc)
+    data = numpy.empty(size, numpy.intc)
+    pointers = (c_void_p * max(1, n))(*(x._as_parameter_ for x in nodes))
+    m = lib.tb_history_forest(self, n, pointers, index.ctypes.data_as(IntArray),
+      parent.ctypes.data_as(IntArray), data.ctypes.data_as(IntArray))
+    return index[:n], parent[:m], data[:m]
+
+  def active(self):
+    p = lib.tb_active(self)
+    while p:
+      yield Node(pointer=p)
+      p = lib.tb_next_active(self, p)
+
+  def open_statistics(self, path):
+    assert self.statistics_file is None
+    self.statistics_file = libc.fopen(os.fsencode(path), b'w')
+    if not self.statistics_file:
+      raise OSError('cannot write to {}'.format(path))
+
+  def start_collecting_statistics(self, path):
+    self.open_statistics(path)
+    lib.tb_start_collecting_statistics(self, self.statistics_file)
+
+  # Keeps histograms in the library; the summary goes to |path| when the tree
+  # is closed, or on print_statistics.
+  def start_aggregating_statistics(self, path):
+    self.open_statistics(path)
+    lib.tb_start_aggregating_statistics(self, self.statistics_file)
+
+  # Also records the wall-clock time of each operation; needs aggregation.
+  def start_timing(self):
+    lib.tb_start_timing(self)
+
+  def print_statistics(self):
+    lib.tb_print_statistics(self, self.statistics_file)
+
+  def stop_collecting_statistics(self):
+    if self.statistics_file is None:
+      return
+    lib.tb_stop_collecting_statistics(self)
+    libc.fclose(self.statistics_file)
+    self.statistics_file = None
+
+  # Frees the tree and all nodes still in it. Statistics keep being collected
+  # until the end, as with delete() in C.
+  def close(self):
+    if getattr(self, '_as_parameter_', None) is None:
+      return
+    lib.delete(self)
+    self._as_parameter_ = None
+    if self.statistics_file is not None:
+      libc.fclose(self.statistics_file)
+      self.statistics_file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __del__(self):
+    self.close()
+
+# vim:sts=2:sw=2:
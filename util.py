@@ -1,3 +1,9 @@
+from argparse import ArgumentTypeError
+from pathlib import Path
+
+import os
+import shutil
+
 algorithms = ['naive', 'gc', 'amortized', 'real-time']
 
 def posint(s):
@@ -5,3 +11,13 @@ def posint(s):
   if not (i > 0):
     raise ValueError
   return i
+
+# For -E: a path, which is made absolute, or else a command, which is looked
+# up in PATH as the shell would.
+def executable_path(s):
+  if os.sep in s or (os.altsep and os.altsep in s):
+    return str(Path(s).resolve())
+  found = shutil.which(s)
+  if found is None:
+    raise ArgumentTypeError('{} is not in PATH'.format(s))
+  return str(Path(found).resolve())
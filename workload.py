@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Synthetic traces of tree buffer operations, in the format of the datasets:
+# text commands for ../main without the initialize, which batch_run.py and
+# benchmark.py add, for a root with id 0. Each kind of workload is a random
+# frontier of active nodes, with its own shape:
+#   chain: one active node, expanded into one child at a time
+#   fanout: a wide frontier, whose nodes are expanded into many children
+#   frontier: like the monitor of an NFA, a small frontier in which a node
+#     often stays active after it gets children (add_child)
+#   bursty: a frontier that grows, and then loses most of its nodes at once
+# The same kind, size and seed always give the same trace.
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from collections import namedtuple
+from random import Random
+from util import posint
+
+import bz2
+
+argparser = ArgumentParser(description='''\
+  Writes a synthetic trace of treebuffer operations.
+''', formatter_class=RawDescriptionHelpFormatter)
+
+# |target| is the size of the frontier that growth stops at; a node that grows
+# gets between |branching[0]| and |branching[1]| children, and stays active
+# with probability |keep|. When the frontier reaches |target|, a fraction
+# |burst| of it is deactivated at once if |burst| is nonzero, and otherwise
+# one node is.
+Shape = namedtuple('Shape', 'target branching keep burst')
+
+shapes = {
+  'chain' : Shape(1, (1, 1), 0, 0),
+  'fanout' : Shape(4096, (8, 32), 0, 0),
+  'frontier' : Shape(64, (1, 3), 0.5, 0),
+  'bursty' : Shape(1024, (1, 2), 0.3, 0.9) }
+
+argparser.add_argument('kind', choices=sorted(shapes),
+  help='shape of the workload')
+argparser.add_argument('output',
+  help='where to write the trace (compressed if it ends in .bz2)')
+argparser.add_argument('-n', '--operations', type=posint, default=200000,
+  help='number of operations (default: 200000)')
+argparser.add_argument('-s', '--seed', type=int, default=1,
+  help='seed of the random generator (default: 1)')
+argparser.add_argument('--history-rate', type=float, default=0.01,
+  help='probability of a history query after each operation (default: 0.01)')
+
+# Yields the lines of a trace of |operations| operations of workload |kind|.
+def generate(kind, operations, seed, history_rate=0.01):
+  shape = shapes[kind]
+  rng = Random(seed)
+  active = [0] # ids of the active nodes, in no order
+  free_ids = []
+  fresh = 1
+  data = 0
+  done = 0
+  def new_id():
+    nonlocal fresh
+    if free_ids:
+      return free_ids.pop()
+    fresh += 1
+    return fresh - 1
+  # Deactivates active[i]; the order of |active| does not matter.
+  def remove(i):
+    x = active[i]
+    active[i] = active[-1]
+    active.pop()
+    free_ids.append(x)
+    return 'deactivate {}\n'.format(x)
+  while done < operations:
+    i = rng.randrange(len(active))
+    if len(active) >= shape.target and len(active) > 1:
+      if shape.burst:
+        for _ in range(int(len(active) * shape.burst)):
+          yield remove(rng.randrange(len(active)))
+          done += 1
+      else:
+        yield remove(i)
+        done += 1
+    else:
+      x = active[i]
+      k = rng.randint(*shape.branching)
+      children = []
+      for _ in range(k):
+        children.append((new_id(), data))
+        data += 1
+      if rng.random() < shape.keep:
+        for c, d in children:
+          yield 'add_child {} {}:{}\n'.format(x, c, d)
+        done += k
+      else:
+        yield 'expand {}{}\n'.format(x,
+          ''.join(' {}:{}'.format(c, d) for c, d in children))
+        active[i] = active[-1]
+        active.pop()
+        free_ids.append(x)
+        done += 1
+      active.extend(c for c, _ in children)
+    if history_rate and rng.random() < history_rate:
+      yield 'history {}\n'.format(active[rng.randrange(len(active))])
+      done += 1
+
+def write_trace(path, kind, operations, seed, history_rate=0.01):
+  open_file = bz2.open if path.endswith('.bz2') else open
+  with open_file(path, 'wt') as out:
+    lines = []
+    for line in generate(kind, operations, seed, history_rate):
+      lines.append(line)
+      if len(lines) >= 1 << 12:
+        out.write(''.join(lines))
+        lines.clear()
+    out.write(''.join(lines))
+
+def main():
+  args = argparser.parse_args()
+  if not 0 <= args.history_rate <= 1:
+    argparser.error('--history-rate must be between 0 and 1')
+  write_trace(args.output, args.kind, args.operations, args.seed,
+    args.history_rate)
+
+if __name__ == '__main__':
+  main()
+
+# vim:sts=2:sw=2: